@@ -603,7 +603,7 @@ def _extract_main_features(user_journey: str) -> List[Dict]:
     Returns list of dicts with 'title' and 'description'
     """
     # Use OpenAI to extract main features
-    import openai
+    from preprocess.llm_cache import chat_completion
 
     system_prompt = "You are a feature analyst expert at summarizing key application capabilities from user journey descriptions."
     user_prompt = f"""
@@ -642,7 +642,7 @@ Return ONLY a valid JSON object containing a single key "features" whose value i
 **Top 5 Features (JSON object only):**
 """
 
-    response = openai.chat.completions.create(
+    response = chat_completion(
         model="gpt-4o",
         messages=[
             {"role": "system", "content": system_prompt},
@@ -33,7 +33,7 @@ def create_feature_presentation(keyframe_summaries: List[str],
     personalization = None
     if website_context:
         try:
-            import openai
+            from preprocess.llm_cache import chat_completion
             personalization_prompt = f"""
 You are an expert product marketer and user experience researcher. Given the following website context and user journey, summarize:
 1. What the website offers (value proposition)
@@ -47,7 +47,7 @@ Website Context:
 User Journey:
 {user_journey}
 """
-            response = openai.chat.completions.create(
+            response = chat_completion(
                 model="gpt-4o",
                 messages=[{"role": "user", "content": personalization_prompt}],
                 response_format={ "type": "json_object" }
@@ -80,7 +80,7 @@ User Journey:
     localized_subtitle = "Generated from User Journey Analysis"
     localized_summary = "Key Features Summary"
     if language and language.lower() != "english":
-        import openai
+        from preprocess.llm_cache import chat_completion
         system_prompt = "You are an expert translator specializing in UI text."
         user_prompt = f"""
 Translate the following English phrases into {language}.
@@ -106,7 +106,7 @@ Example for Spanish:
 
 **Output (JSON only):**
 """
-        response = openai.chat.completions.create(
+        response = chat_completion(
             model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": system_prompt},
@@ -280,7 +280,7 @@ def _extract_main_features(user_journey: str, language: str = None) -> List[Dict
     Returns list of dicts with 'title' and 'description'
     """
     # Use OpenAI to extract main features
-    import openai
+    from preprocess.llm_cache import chat_completion
 
     system_prompt = "You are a feature analyst expert at summarizing key application capabilities from user journey descriptions."
     user_prompt = f"""
@@ -320,7 +320,7 @@ Return ONLY a valid JSON object containing a single key "features" whose value i
 **Top 5 Features (JSON object only):**
 """
 
-    response = openai.chat.completions.create(
+    response = chat_completion(
         model="gpt-4o",
         messages=[
             {"role": "system", "content": system_prompt},
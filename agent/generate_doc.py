@@ -1,13 +1,16 @@
-import openai
-
 import os
 import json
 
 import re
 from pathlib import Path
-import openai # Ensure openai is imported
+from preprocess.llm_cache import chat_completion
+from preprocess.storage import atomic_write_text
+from agent.retrieval import DocContext, relevant_transcript, section_query, OVERVIEW_TOP_K
 
 def generate_folder_structure(transcript, user_journey_flow, model="gpt-4o-mini", language=None):
+    # The journey is the outline of the structure and goes in whole; of a long transcript only
+    # the parts that best cover the journey steps are sent
+    transcript = relevant_transcript(transcript, user_journey_flow, OVERVIEW_TOP_K)
     system_prompt = "You are an expert documentation architect specializing in creating logical, outcome-oriented information structures."
     user_prompt = f"""
 Based on the provided User Journey Flow and Transcript from a product demo, propose a logical folder and markdown file structure for a practical 'how-to' guide.
@@ -50,7 +53,7 @@ Based on the provided User Journey Flow and Transcript from a product demo, prop
 ---
 **Proposed Folder Structure (JSON only):**
 """
-    response = openai.chat.completions.create(
+    response = chat_completion(
         model=model,
         messages=[
             {"role": "system", "content": system_prompt},
@@ -92,19 +95,28 @@ def generate_markdown_skeletons(folder_structure, user_journey_flow, base_path="
                 recurse(child, full_path, parent_nav=path)
     recurse(folder_structure, base_path)
 
-def populate_markdown_files(folder_structure, transcript, user_journey_flow, base_path="output/docs", model="gpt-4o-mini", language=None):
-    """
-    For each markdown file in the folder structure, use AI to populate it with detailed content.
-    """
-    def recurse(struct, path):
-        for name, child in struct.items():
-            full_path = os.path.join(path, name)
-            if child is None:
-                # Read skeleton
-                with open(full_path, "r") as f:
-                    skeleton = f.read()
-                system_prompt = "You are a practical documentation writer, skilled at creating clear, outcome-oriented how-to guides based on provided context."
-                user_prompt = f"""
+# Files populated at once, and extra attempts for a file whose generation fails
+POPULATE_WORKERS = 8
+POPULATE_RETRIES = 2
+
+def _markdown_files(struct, path):
+    for name, child in struct.items():
+        full_path = os.path.join(path, name)
+        if child is None:
+            yield full_path
+        else:
+            yield from _markdown_files(child, full_path)
+
+def _populate_file(full_path, context, base_path, model, language):
+    # Read skeleton
+    with open(full_path, "r") as f:
+        skeleton = f.read()
+    # Only the journey steps and transcript chunks about this file's section
+    query = section_query(full_path, base_path, skeleton)
+    user_journey_flow = context.journey_for(query)
+    transcript = context.transcript_for(query)
+    system_prompt = "You are a practical documentation writer, skilled at creating clear, outcome-oriented how-to guides based on provided context."
+    user_prompt = f"""
 Your task is to write the content for a specific section of a documentation guide, based on the provided User Journey Flow, Transcript, and the Markdown Skeleton for this section.
 
 **Goal:** Create an easy-to-follow, practical guide for the user actions covered in this section.
@@ -142,20 +154,58 @@ Your task is to write the content for a specific section of a documentation guid
 ---
 **Populated Markdown Content (for this file only):**
 """
-                response = openai.chat.completions.create(
-                    model=model,
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": user_prompt}
-                    ],
-                    max_tokens=1200 # Increased tokens for potentially longer content
-                )
-                # Ensure writing in UTF-8 for broader language support
-                with open(full_path, "w", encoding="utf-8") as f:
-                    f.write(response.choices[0].message.content)
-            else:
-                recurse(child, full_path)
-    recurse(folder_structure, base_path)
+    response = chat_completion(
+        model=model,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        max_tokens=1200 # Increased tokens for potentially longer content
+    )
+    content = response.choices[0].message.content
+    if not content or not content.strip():
+        raise ValueError("empty response")
+    # Written atomically in UTF-8 as soon as it arrives, so readers never see a half-written file
+    atomic_write_text(full_path, content)
+    return full_path
+
+def populate_markdown_files(folder_structure, transcript, user_journey_flow, base_path="output/docs", model="gpt-4o-mini", language=None, max_workers=POPULATE_WORKERS, retries=POPULATE_RETRIES):
+    """
+    For each markdown file in the folder structure, use AI to populate it with detailed content.
+
+    Files are generated concurrently (up to `max_workers` requests in flight) and each one is
+    written as soon as its content arrives. Each prompt carries only the transcript chunks and
+    journey steps relevant to the file (see agent.retrieval). A file that fails is retried up to
+    `retries` times; files that still fail keep their skeleton and are reported in a RuntimeError
+    once all other files are done, so completed files are never lost.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from preprocess.llm_scheduler import with_current_priority
+
+    def populate(full_path):
+        for attempt in range(retries + 1):
+            try:
+                return _populate_file(full_path, context, base_path, model, language)
+            except Exception as e:
+                if attempt == retries:
+                    raise
+                print(f"[WARN] Populating {full_path} failed ({e}), retrying ({attempt + 1}/{retries})")
+
+    files = list(_markdown_files(folder_structure, base_path))
+    context = DocContext(transcript, user_journey_flow)
+    populate = with_current_priority(populate)
+    failed = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(populate, full_path): full_path for full_path in files}
+        for future, full_path in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                failed[full_path] = e
+    if failed:
+        details = "; ".join(f"{path}: {e}" for path, e in failed.items())
+        raise RuntimeError(f"Could not populate {len(failed)} of {len(files)} markdown files: {details}")
+    return files
 
 # (Legacy) Single-step doc generator for reference
 
@@ -196,7 +246,7 @@ Based on the provided Transcript and User Journey Flow from a product demo, crea
 ---
 **Generated How-To Guide (Markdown):**
 """
-    response = openai.chat.completions.create(
+    response = chat_completion(
         model=model, # Use specified model
         messages=[
             {"role": "system", "content": system_prompt},
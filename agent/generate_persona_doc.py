@@ -1,10 +1,12 @@
-import openai
 import os
 import json
 import re
-import openai # Ensure openai is imported if not already
+from preprocess.llm_cache import chat_completion
+from agent.retrieval import relevant_transcript, OVERVIEW_TOP_K
 
 def extract_personas_usecases(transcript, keyframe_summaries, model="gpt-4o-mini"):
+    # Of a long transcript, send the parts that explain what the keyframes show
+    transcript = relevant_transcript(transcript, str(keyframe_summaries), OVERVIEW_TOP_K)
     system_prompt = "You are a product strategist analyzing product demo materials."
     user_prompt = f"""
 Based on the provided transcript and keyframe summaries from a product/app demo video, perform the following analysis:
@@ -49,7 +51,7 @@ Return ONLY valid JSON matching this structure exactly:
 ---
 **Analysis Result (JSON only):**
 """
-    response = openai.chat.completions.create(
+    response = chat_completion(
         model=model,
         messages=[
             {"role": "system", "content": system_prompt},
@@ -71,6 +73,8 @@ Return ONLY valid JSON matching this structure exactly:
         raise
 
 def select_lucrative_features(transcript, keyframe_summaries, persona, model="gpt-4o-mini"):
+    # Of a long transcript, send the parts about this persona and the applications relevant to them
+    transcript = relevant_transcript(transcript, json.dumps(persona))
     system_prompt = "You are a product strategist identifying high-value features for specific user segments."
     user_prompt = f"""
 Given the transcript and keyframe summaries of an app demo, and the specific user persona provided below, analyze the entire app demonstration.
@@ -114,7 +118,7 @@ Return ONLY valid JSON matching this structure exactly:
 ---
 **Top Features Analysis (JSON only):**
 """
-    response = openai.chat.completions.create(
+    response = chat_completion(
         model=model,
         messages=[
             {"role": "system", "content": system_prompt},
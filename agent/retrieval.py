@@ -0,0 +1,144 @@
+import re
+import math
+from collections import Counter
+from preprocess.transcript import Transcript
+
+# Inputs shorter than this (in characters) are sent whole; retrieval only kicks in for long videos
+FULL_CONTEXT_CHARS = 6000
+# Transcript segments are grouped into chunks of roughly this many characters before indexing
+CHUNK_CHARS = 600
+# Chunks handed to a prompt about one topic (a doc file, a persona) ...
+TRANSCRIPT_TOP_K = 8
+JOURNEY_TOP_K = 6
+# ... and to prompts that need an overview of the whole demo (folder structure, persona extraction)
+OVERVIEW_TOP_K = 16
+
+_STOPWORDS = frozenset("""
+a an and are as at be but by can do for from has have how i in is it its of on or so that the
+then this to was we what when which will with you your
+""".split())
+_JOURNEY_STEP = re.compile(r"^\s*(?:#+\s|\d+[.)]\s|\*\*\d+)")
+_HTML_COMMENT = re.compile(r"<!--.*?-->", re.S)
+
+def tokenize(text):
+    return [t for t in re.findall(r"\w+", text.lower()) if len(t) > 1 and t not in _STOPWORDS]
+
+class BM25Index:
+    """Okapi BM25 over a list of text chunks."""
+
+    def __init__(self, chunks, k1=1.5, b=0.75):
+        self.chunks = chunks
+        self.k1 = k1
+        self.b = b
+        self.terms = [Counter(tokenize(chunk)) for chunk in chunks]
+        self.lengths = [sum(tf.values()) for tf in self.terms]
+        self.avg_length = (sum(self.lengths) / len(chunks)) if chunks else 0.0
+        df = Counter(term for tf in self.terms for term in tf)
+        n = len(chunks)
+        self.idf = {term: math.log(1 + (n - f + 0.5) / (f + 0.5)) for term, f in df.items()}
+
+    def scores(self, query):
+        query_terms = Counter(tokenize(query))
+        scores = []
+        for tf, length in zip(self.terms, self.lengths):
+            norm = self.k1 * (1 - self.b + self.b * length / (self.avg_length or 1))
+            score = 0.0
+            for term, qf in query_terms.items():
+                f = tf.get(term)
+                if f:
+                    score += qf * self.idf[term] * f * (self.k1 + 1) / (f + norm)
+            scores.append(score)
+        return scores
+
+    def top_k(self, query, k):
+        """Indices of the `k` best-matching chunks, in their original order."""
+        scores = self.scores(query)
+        best = sorted(range(len(scores)), key=lambda i: (-scores[i], i))[:k]
+        return sorted(i for i in best if scores[i] > 0)
+
+def _transcript_text(transcript):
+    return transcript if isinstance(transcript, str) else Transcript.coerce(transcript).render()
+
+def transcript_chunks(transcript, chunk_chars=CHUNK_CHARS):
+    """Group consecutive lines of the rendered transcript (a Transcript, segments or text) into chunks."""
+    lines = _transcript_text(transcript).splitlines()
+    chunks, current, size = [], [], 0
+    for line in filter(None, (line.strip() for line in lines)):
+        current.append(line)
+        size += len(line) + 1
+        if size >= chunk_chars:
+            chunks.append("\n".join(current))
+            current, size = [], 0
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+def journey_chunks(user_journey_flow):
+    """Split a How-To journey into its steps (numbered items or headings, with their bullet points)."""
+    chunks, current = [], []
+    for line in user_journey_flow.splitlines():
+        if _JOURNEY_STEP.match(line) and current:
+            chunks.append("\n".join(current).strip())
+            current = []
+        current.append(line)
+    chunks.append("\n".join(current).strip())
+    chunks = [chunk for chunk in chunks if chunk]
+    if len(chunks) <= 1:
+        chunks = [p.strip() for p in re.split(r"\n\s*\n", user_journey_flow) if p.strip()]
+    return chunks
+
+def _join(chunks, indices):
+    """Selected chunks in order, with a marker wherever chunks in between were left out."""
+    parts = []
+    for n, i in enumerate(indices):
+        if (n == 0 and i > 0) or (n > 0 and i != indices[n - 1] + 1):
+            parts.append("[...]")
+        parts.append(chunks[i])
+    if indices and indices[-1] != len(chunks) - 1:
+        parts.append("[...]")
+    return "\n".join(parts)
+
+class _Retriever:
+    def __init__(self, source, chunks):
+        self.source = source
+        self.small = sum(len(chunk) + 1 for chunk in chunks) <= FULL_CONTEXT_CHARS
+        self.chunks = chunks
+        self.index = None if self.small else BM25Index(chunks)
+
+    def select(self, query, k):
+        # Short inputs go through unchanged, so their prompts (and LLM cache keys) stay as before
+        if self.small:
+            return self.source
+        indices = self.index.top_k(query, k)
+        if not indices:
+            indices = list(range(min(k, len(self.chunks))))
+        return _join(self.chunks, indices)
+
+class DocContext:
+    """
+    Transcript and user journey indexed once per video, so every prompt gets only the chunks
+    relevant to its topic instead of the whole transcript and journey.
+    """
+
+    def __init__(self, transcript, user_journey_flow=""):
+        # Segment lists are rendered compactly too, not as their Python repr
+        if not isinstance(transcript, str):
+            transcript = Transcript.coerce(transcript)
+        self._transcript = _Retriever(transcript, transcript_chunks(transcript))
+        self._journey = _Retriever(user_journey_flow or "", journey_chunks(user_journey_flow or ""))
+
+    def transcript_for(self, query, k=TRANSCRIPT_TOP_K):
+        return self._transcript.select(query, k)
+
+    def journey_for(self, query, k=JOURNEY_TOP_K):
+        return self._journey.select(query, k)
+
+def relevant_transcript(transcript, query, k=TRANSCRIPT_TOP_K):
+    """The transcript chunks most relevant to `query` (the whole transcript if it is short)."""
+    return DocContext(transcript).transcript_for(query, k)
+
+def section_query(full_path, base_path, skeleton=""):
+    """Retrieval query for one doc file: its folder and file names plus the skeleton's headings."""
+    rel = full_path[len(base_path):] if full_path.startswith(base_path) else full_path
+    name = re.sub(r"[/\\_-]", " ", re.sub(r"\.md$", "", rel))
+    return name + "\n" + _HTML_COMMENT.sub("", skeleton)
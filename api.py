@@ -1,19 +1,45 @@
 import os
 import shutil
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import FastAPI, UploadFile, File, BackgroundTasks, HTTPException, Request
 from fastapi.responses import FileResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from preprocess.extract_audio import extract_audio
-from preprocess.transcribe import transcribe_audio
-from preprocess.keyframes import extract_keyframes
-from preprocess.keyframe_analysis import summarize_keyframe, consolidate_user_journey
+from preprocess.extract_audio import extract_audio_pcm
+from preprocess.transcribe import DEFAULT_MODEL, transcribe_audio, submit_transcription, warm_pool
+from preprocess.live_transcribe import IncrementalTranscriber
+from preprocess.transcript import Transcript
+from preprocess.storage import atomic_write_text
+from preprocess.keyframes import DEFAULT_SAMPLE_INTERVAL, extract_keyframes, stream_keyframes
+from preprocess.keyframe_analysis import summarize_keyframes, consolidate_user_journey
+from preprocess.scratch import job_scratch, scratch_root, cleanup_stale_scratch
+from preprocess.llm_scheduler import llm_priority
+from preprocess.cache import cache_key, cache_get, cache_put, cache_iter, file_digest, relocate_keyframes
 from agent.generate_doc import generate_folder_structure, generate_markdown_skeletons, populate_markdown_files
 from agent.generate_persona_doc import extract_personas_usecases, select_lucrative_features
 from agent.create_presentation import create_feature_presentation, create_google_feature_presentation
 
 app = FastAPI()
 
+@app.on_event("startup")
+def warm_whisper():
+    """Start the Whisper worker processes at startup so the first /process job doesn't pay for loading the model."""
+    warm_pool(max(1, TRANSCRIBE_WORKERS))
+
+@app.on_event("startup")
+def clean_scratch():
+    """Remove scratch dirs left behind by jobs of a previous run that was killed mid-job."""
+    cleanup_stale_scratch()
+
+@app.on_event("startup")
+def reap_realtime_sessions():
+    """Drop realtime uploads that stopped sending chunks without being finished, so their transcriber threads end."""
+    def reap():
+        while True:
+            time.sleep(60)
+            drop_stale_realtime_sessions()
+    threading.Thread(target=reap, daemon=True, name="realtime-reaper").start()
+
 # --- CORS middleware for frontend-backend communication ---
 from fastapi.middleware.cors import CORSMiddleware
 app.add_middleware(
@@ -90,6 +116,33 @@ UPLOAD_DIR = "uploads"
 OUTPUT_DIR = "output/docs"
 STATUS = {}
 REALTIME_SESSIONS = {}
+# Processes used to decode/hash video segments during keyframe extraction
+KEYFRAME_WORKERS = int(os.getenv("KEYFRAME_WORKERS", os.cpu_count() or 1))
+# Worker processes for silence-split parallel transcription (0 = single Whisper call in one worker process)
+TRANSCRIBE_WORKERS = int(os.getenv("TRANSCRIBE_WORKERS", 0))
+# Seconds between incremental transcription passes during realtime uploads
+REALTIME_TRANSCRIBE_INTERVAL = float(os.getenv("REALTIME_TRANSCRIBE_INTERVAL", 10))
+# Realtime uploads with no chunk for this many seconds are dropped
+REALTIME_SESSION_TIMEOUT = float(os.getenv("REALTIME_SESSION_TIMEOUT", 600))
+# Seconds between frames hashed during keyframe extraction (0 = every frame)
+KEYFRAME_SAMPLE_INTERVAL = float(os.getenv("KEYFRAME_SAMPLE_INTERVAL", DEFAULT_SAMPLE_INTERVAL)) or None
+# Sample frames more densely during visual activity and sparsely on static screens (serial only:
+# KEYFRAME_WORKERS is ignored when set)
+KEYFRAME_ADAPTIVE = os.getenv("KEYFRAME_ADAPTIVE", "0") == "1"
+# "tiles" decides keyframes from per-tile changes, ignoring cursor moves and caret blinks; tiles that
+# keep changing during the first KEYFRAME_MASK_LEARN_SECONDS (clocks, spinners) are masked out
+KEYFRAME_CHANGE_DETECTOR = os.getenv("KEYFRAME_CHANGE_DETECTOR", "phash")
+KEYFRAME_MASK_LEARN_SECONDS = float(os.getenv("KEYFRAME_MASK_LEARN_SECONDS", 0))
+# Optional cap on new keyframes (= vision calls) per minute of video
+KEYFRAMES_PER_MINUTE = float(os.getenv("KEYFRAMES_PER_MINUTE", 0)) or None
+# Vision calls in flight per job; 0 analyzes keyframes one by one with the previous summary as context
+VISION_CONCURRENCY = int(os.getenv("VISION_CONCURRENCY", 8))
+# Consecutive keyframes sent together in one vision request (1 = one request per keyframe)
+VISION_BATCH_SIZE = int(os.getenv("VISION_BATCH_SIZE", 4))
+# Keyframe summaries per consolidation window; longer videos are consolidated map-reduce style (0 = single prompt)
+JOURNEY_WINDOW_SIZE = int(os.getenv("JOURNEY_WINDOW_SIZE", 40))
+# Runs the audio -> transcript branch of process_video alongside the keyframe branch
+AUDIO_BRANCH_EXECUTOR = ThreadPoolExecutor(thread_name_prefix="audio-branch")
 
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(OUTPUT_DIR, exist_ok=True)
@@ -225,56 +278,99 @@ def download_docs_zip(video_id: str):
     base_dir = os.path.abspath(os.path.join(OUTPUT_DIR, video_id))
     if not os.path.exists(base_dir):
         raise HTTPException(status_code=404, detail="Documentation folder not found")
-    import tempfile
     mem_zip = BytesIO()
     with zipfile.ZipFile(mem_zip, "w", zipfile.ZIP_DEFLATED) as zf:
         for root, dirs, files in os.walk(base_dir):
+            # Full-resolution keyframe JPEGs are only kept for the decks, not part of the docs
+            if root == base_dir and "keyframes" in dirs:
+                dirs.remove("keyframes")
             for file in files:
                 abs_path = os.path.join(root, file)
                 rel_path = os.path.relpath(abs_path, base_dir)
                 zf.write(abs_path, rel_path)
     mem_zip.seek(0)
-    # Write BytesIO to a temp file
-    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=f"_{video_id}.zip")
+    # Write BytesIO to a temp file, deleted once the response has been sent
+    import tempfile
+    from starlette.background import BackgroundTask
+    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=f"_{video_id}.zip", dir=scratch_root())
     tmp.write(mem_zip.read())
     tmp.close()
     # Return path to FileResponse
-    return FileResponse(tmp.name, filename=f"docs_{video_id}.zip", media_type="application/zip")
-
-def process_video(video_id: str, video_path: str, language: str = None, prompt: str = "", persona: str = ""):
+    return FileResponse(tmp.name, filename=f"docs_{video_id}.zip", media_type="application/zip", background=BackgroundTask(os.remove, tmp.name))
+
+def keyframe_workers() -> int:
+    """Adaptive sampling depends on the previous sample, so it always runs in a single process."""
+    return 1 if KEYFRAME_ADAPTIVE else KEYFRAME_WORKERS
+
+def keyframes_dir(video_id: str) -> str:
+    """Per-job keyframe directory, also where create_presentation_endpoint looks for deck images."""
+    return os.path.join(OUTPUT_DIR, video_id, "keyframes")
+
+def transcript_branch(digest: str, video_path: str):
+    """Audio -> transcript half of process_video: ffmpeg decode here, Whisper in the worker pool."""
+    transcript_key = cache_key("transcript", digest, model=DEFAULT_MODEL)
+    # Entries written before the Transcript type are lists of segment dicts
+    transcript = Transcript.coerce(cache_get(transcript_key))
+    if transcript is None:
+        # Audio is decoded once, straight into memory, and handed to Whisper as an array. It isn't
+        # cached: raw PCM is ~230 MB per hour and nothing needs it once the transcript is cached
+        audio = extract_audio_pcm(video_path)
+        transcript = submit_transcription(audio, workers=TRANSCRIBE_WORKERS).result()
+        cache_put(transcript_key, transcript)
+    return transcript
+
+def process_video(video_id: str, video_path: str, language: str = None, prompt: str = "", persona: str = "", keyframe_backend: str = "opencv", transcript=None):
     try:
-        STATUS[video_id] = "extracting_audio"
-        audio_path = extract_audio(video_path)
-
-        STATUS[video_id] = "transcribing"
-        transcript = transcribe_audio(audio_path)
-
-        STATUS[video_id] = "extracting_keyframes"
-        keyframes = extract_keyframes(video_path)
-
-        STATUS[video_id] = f"analyzing_keyframes: 0/{len(keyframes)}"
-        keyframe_summaries = []
-        prev_context = None
-        for idx, kf in enumerate(keyframes):
-            STATUS[video_id] = f"analyzing_keyframes: {idx+1}/{len(keyframes)}"
-            summary = summarize_keyframe(kf['path'], kf['timestamp'], previous_context=prev_context)
-            keyframe_summaries.append(summary)
-            prev_context = '\n'.join(summary.splitlines()[:2])
-
-        STATUS[video_id] = "consolidating_user_journey"
-        user_journey_flow = consolidate_user_journey(keyframe_summaries)
-
-        STATUS[video_id] = "generating_documentation_folder_structure"
-        folder_structure = generate_folder_structure(transcript, user_journey_flow, language=language)
-
-        STATUS[video_id] = "creating_markdown_skeletons"
-        doc_base = os.path.join(OUTPUT_DIR, video_id)
-        generate_markdown_skeletons(folder_structure, user_journey_flow, base_path=doc_base)
-
-        STATUS[video_id] = "populating_documentation_files"
-        populate_markdown_files(folder_structure, transcript, user_journey_flow, base_path=doc_base, language=language)
-
-        STATUS[video_id] = "done"
+        # Intermediate files live in a per-job scratch dir (SCRATCH_DIR, e.g. a tmpfs) removed on exit.
+        # LLM calls are queued by job start time, so earlier jobs get rate-limited capacity first
+        with job_scratch(video_id) as scratch_dir, llm_priority(time.time()):
+            # Results are cached by content, so re-uploads of the same video skip straight to the LLM steps
+            digest = file_digest(video_path)
+
+            # The audio -> transcript branch runs concurrently with keyframes -> summaries; the two only
+            # meet at generate_folder_structure. A transcript may already exist (realtime uploads are
+            # transcribed while they are recorded).
+            STATUS[video_id] = "transcribing_and_extracting_keyframes"
+            if transcript is None:
+                transcript_future = AUDIO_BRANCH_EXECUTOR.submit(transcript_branch, digest, video_path)
+            else:
+                transcript_future = None
+
+            # Keyframes are analyzed as soon as they are extracted, while decoding continues in the background
+            keyframe_options = dict(dedupe="global", revisits=True, analysis_width=512, keyframes_per_minute=KEYFRAMES_PER_MINUTE, sample_interval=KEYFRAME_SAMPLE_INTERVAL, adaptive=KEYFRAME_ADAPTIVE,
+                                    change_detector=KEYFRAME_CHANGE_DETECTOR, mask_learn_seconds=KEYFRAME_MASK_LEARN_SECONDS)
+            keyframes_key = cache_key("keyframes", digest, backend=keyframe_backend, **keyframe_options)
+            cached = cache_get(keyframes_key)
+            keyframes = cached and relocate_keyframes(cached, keyframes_dir(video_id))
+            if not keyframes:
+                keyframes = cache_iter(keyframes_key, stream_keyframes(video_path, output_dir=keyframes_dir(video_id), workers=keyframe_workers(), backend=keyframe_backend, scratch_dir=scratch_dir, **keyframe_options))
+            def on_progress(idx, kf):
+                STATUS[video_id] = f"analyzing_keyframes: {idx+1}"
+            keyframe_summaries = summarize_keyframes(keyframes, on_progress=on_progress, concurrency=VISION_CONCURRENCY, batch_size=VISION_BATCH_SIZE)
+
+            STATUS[video_id] = "consolidating_user_journey"
+            user_journey_flow = consolidate_user_journey(keyframe_summaries, window_size=JOURNEY_WINDOW_SIZE)
+
+            if transcript_future is not None:
+                if not transcript_future.done():
+                    STATUS[video_id] = "transcribing"
+                transcript = transcript_future.result()
+            # Columnar transcript.json is what persona_analysis and create_presentation_endpoint load;
+            # transcript.txt is the rendered text for reading
+            doc_base = os.path.join(OUTPUT_DIR, video_id)
+            atomic_write_text(os.path.join(doc_base, "transcript.json"), transcript.dumps())
+            atomic_write_text(os.path.join(doc_base, "transcript.txt"), transcript.render())
+
+            STATUS[video_id] = "generating_documentation_folder_structure"
+            folder_structure = generate_folder_structure(transcript, user_journey_flow, language=language)
+
+            STATUS[video_id] = "creating_markdown_skeletons"
+            generate_markdown_skeletons(folder_structure, user_journey_flow, base_path=doc_base)
+
+            STATUS[video_id] = "populating_documentation_files"
+            populate_markdown_files(folder_structure, transcript, user_journey_flow, base_path=doc_base, language=language)
+
+            STATUS[video_id] = "done"
     except Exception as e:
         STATUS[video_id] = f"error: {str(e)}"
 
@@ -297,15 +393,15 @@ def create_presentation_endpoint(video_id: str, language: str = None, companyWeb
     Optionally takes companyWebsite for research-based messaging.
     """
     doc_base = os.path.join(OUTPUT_DIR, video_id)
-    transcript_file = os.path.join(doc_base, "transcript.txt")
+    transcript_file = os.path.join(doc_base, "transcript.json")
     user_journey_file = os.path.join(doc_base, "user_journey.txt")
     keyframes_dir = os.path.join(doc_base, "keyframes")
     keyframe_summaries_file = os.path.join(doc_base, "keyframe_summaries.json")
     # Load transcript
     if not os.path.exists(transcript_file):
         raise HTTPException(status_code=404, detail="Transcript not found")
-    with open(transcript_file, "r") as f:
-        transcript = f.read()
+    with open(transcript_file, encoding="utf-8") as f:
+        transcript = Transcript.loads(f.read())
     # Load user journey
     if not os.path.exists(user_journey_file):
         raise HTTPException(status_code=404, detail="User journey not found")
@@ -377,6 +473,7 @@ async def process_endpoint(video_id: str, background_tasks: BackgroundTasks, req
     prompt = data.get("prompt", "")
     persona = data.get("persona", "")
     language = data.get("language", None)
+    keyframe_backend = data.get("keyframe_backend", "opencv")
 
     # If language is not provided, try to determine it from prompt/persona
     if not language and (prompt or persona):
@@ -416,7 +513,7 @@ async def process_endpoint(video_id: str, background_tasks: BackgroundTasks, req
         except Exception as e:
             language = None
 
-    background_tasks.add_task(process_video, video_id, video_path, language, prompt, persona)
+    background_tasks.add_task(process_video, video_id, video_path, language, prompt, persona, keyframe_backend)
     STATUS[video_id] = "processing"
     return {"status": "processing started", "language": language}
 
@@ -440,7 +537,9 @@ def realtime_upload_start():
     session_id = str(uuid.uuid4())
     video_path = os.path.join(UPLOAD_DIR, f"realtime_{session_id}.webm")
     f = open(video_path, "wb")
-    REALTIME_SESSIONS[session_id] = {"file": f, "video_path": video_path}
+    # Transcribe the audio received so far every few seconds while the recording is still uploading
+    transcriber = IncrementalTranscriber(video_path, interval=REALTIME_TRANSCRIBE_INTERVAL, workers=TRANSCRIBE_WORKERS).start()
+    REALTIME_SESSIONS[session_id] = {"file": f, "video_path": video_path, "transcriber": transcriber, "last_chunk": time.time()}
     STATUS[session_id] = "recording"
     return {"session_id": session_id}
 
@@ -455,10 +554,57 @@ async def realtime_upload_chunk(session_id: str, request: Request):
     chunk = await request.body()
     f.write(chunk)
     f.flush()
+    REALTIME_SESSIONS[session_id]["last_chunk"] = time.time()
     return {"status": "chunk received"}
 
+def drop_realtime_session(session_id: str, status: str):
+    """Stop the session's background transcriber and close its file without processing the upload."""
+    session = REALTIME_SESSIONS.pop(session_id, None)
+    if session is None:
+        return
+    session["transcriber"].stop()
+    session["file"].close()
+    STATUS[session_id] = status
+
+def drop_stale_realtime_sessions():
+    cutoff = time.time() - REALTIME_SESSION_TIMEOUT
+    for session_id, session in list(REALTIME_SESSIONS.items()):
+        if session["last_chunk"] < cutoff:
+            print(f"[WARN] Dropping realtime upload {session_id}: no chunk for {REALTIME_SESSION_TIMEOUT:.0f}s")
+            drop_realtime_session(session_id, "error: realtime upload timed out")
+
+@app.delete("/realtime-upload/{session_id}")
+def realtime_upload_cancel(session_id: str):
+    """
+    Cancels a real-time upload without processing it.
+    """
+    if session_id not in REALTIME_SESSIONS:
+        raise HTTPException(status_code=404, detail="Session not found")
+    drop_realtime_session(session_id, "cancelled")
+    return {"status": "cancelled"}
+
+def finish_realtime_session(session_id: str, video_path: str, transcriber: IncrementalTranscriber):
+    """Transcribe the tail the background worker hasn't committed yet, then run the normal pipeline."""
+    try:
+        STATUS[session_id] = "transcribing_tail"
+        transcript = transcriber.finish()
+    except Exception as e:
+        STATUS[session_id] = f"error: {str(e)}"
+        return
+    process_video(session_id, video_path, transcript=transcript)
+
+@app.get("/realtime-upload/transcript/{session_id}")
+def realtime_upload_transcript(session_id: str):
+    """
+    Returns the rolling transcript of an in-progress real-time upload.
+    """
+    if session_id not in REALTIME_SESSIONS:
+        raise HTTPException(status_code=404, detail="Session not found")
+    transcript = REALTIME_SESSIONS[session_id]["transcriber"].transcript()
+    return {"transcript": transcript.render(), "segments": transcript.segments()}
+
 @app.post("/realtime-upload/finish/{session_id}")
-def realtime_upload_finish(session_id: str):
+def realtime_upload_finish(session_id: str, background_tasks: BackgroundTasks):
     """
     Finishes the real-time upload, closes the file, and starts processing.
     """
@@ -466,12 +612,11 @@ def realtime_upload_finish(session_id: str):
         raise HTTPException(status_code=404, detail="Session not found")
     f = REALTIME_SESSIONS[session_id]["file"]
     video_path = REALTIME_SESSIONS[session_id]["video_path"]
+    transcriber = REALTIME_SESSIONS[session_id]["transcriber"]
     f.close()
     del REALTIME_SESSIONS[session_id]
-    # Start normal processing in background
-    from fastapi import BackgroundTasks
-    background_tasks = BackgroundTasks()
-    background_tasks.add_task(process_video, session_id, video_path)
+    # Start normal processing in background; only the untranscribed tail of the audio is left
+    background_tasks.add_task(finish_realtime_session, session_id, video_path, transcriber)
     STATUS[session_id] = "processing"
     return {"status": "processing started", "video_id": session_id}
 
@@ -494,29 +639,21 @@ def persona_analysis(video_id: str, persona: str = None):
     if not audio_path:
         audio_path = None
     # Use transcript from process_video output if available
-    transcript_file = os.path.join(OUTPUT_DIR, video_id, "transcript.txt")
+    transcript_file = os.path.join(OUTPUT_DIR, video_id, "transcript.json")
     if os.path.exists(transcript_file):
-        with open(transcript_file) as f:
-            transcript = f.read()
+        with open(transcript_file, encoding="utf-8") as f:
+            transcript = Transcript.loads(f.read())
     else:
-        from preprocess.transcribe import transcribe_audio
-        transcript = transcribe_audio(audio_path) if audio_path else ""
+        transcript = transcribe_audio(audio_path or extract_audio_pcm(video_path))
     # Load keyframe summaries
     keyframes_json = os.path.join(OUTPUT_DIR, video_id, "keyframe_summaries.json")
     if os.path.exists(keyframes_json):
         with open(keyframes_json) as f:
             keyframe_summaries = f.read()
     else:
-        from preprocess.keyframes import extract_keyframes
-        from preprocess.keyframe_analysis import summarize_keyframe
-        keyframes = extract_keyframes(video_path)
-        keyframe_summaries_list = []
-        prev_context = None
-        for kf in keyframes:
-            summary = summarize_keyframe(kf['path'], kf['timestamp'], previous_context=prev_context)
-            keyframe_summaries_list.append(summary)
-            prev_context = '\n'.join(summary.splitlines()[:2])
-        keyframe_summaries = "\n".join(keyframe_summaries_list)
+        from preprocess.keyframe_analysis import summarize_keyframes
+        keyframes = extract_keyframes(video_path, output_dir=keyframes_dir(video_id), workers=keyframe_workers(), dedupe="global", revisits=True, analysis_width=512, keyframes_per_minute=KEYFRAMES_PER_MINUTE, sample_interval=KEYFRAME_SAMPLE_INTERVAL, adaptive=KEYFRAME_ADAPTIVE, change_detector=KEYFRAME_CHANGE_DETECTOR, mask_learn_seconds=KEYFRAME_MASK_LEARN_SECONDS)
+        keyframe_summaries = "\n".join(summarize_keyframes(keyframes, concurrency=VISION_CONCURRENCY, batch_size=VISION_BATCH_SIZE))
     # Run persona/use-case extraction
     result = extract_personas_usecases(transcript, keyframe_summaries)
     # If a persona is specified, select top features for that persona
@@ -532,6 +669,18 @@ def persona_analysis(video_id: str, persona: str = None):
         result["top_features_for_persona"] = top_features
     return result
 
+@app.get("/llm-cache/stats")
+def llm_cache_stats():
+    """Hit/miss counters of the LLM response cache (see preprocess.llm_cache)."""
+    from preprocess.llm_cache import cache_stats
+    return cache_stats()
+
+@app.get("/llm-scheduler/stats")
+def llm_scheduler_stats():
+    """Per-model queue depth, wait times and retries of the OpenAI rate-limit scheduler."""
+    from preprocess.llm_scheduler import scheduler_stats
+    return scheduler_stats()
+
 @app.get("/status/{video_id}")
 def get_status(video_id: str):
     return {"status": STATUS.get(video_id, "not_found")}
@@ -1,140 +1,106 @@
 import os
 import json
-import pickle
 from pathlib import Path
-from preprocess.extract_audio import extract_audio
-from preprocess.transcribe import transcribe_audio
-from preprocess.keyframes import extract_keyframes
-from preprocess.keyframe_analysis import summarize_keyframe, consolidate_user_journey
+from preprocess.extract_audio import SAMPLE_RATE, extract_audio_pcm
+from preprocess.transcribe import DEFAULT_MODEL, transcribe_audio
+from preprocess.transcript import Transcript
+from preprocess.keyframes import DEFAULT_SAMPLE_INTERVAL, extract_keyframes
+from preprocess.keyframe_analysis import summarize_keyframes, consolidate_user_journey
+from preprocess import llm_cache
+from preprocess.cache import cache_key, cache_get, cache_put, file_digest, text_digest, relocate_keyframes
 from agent.generate_doc import generate_folder_structure, generate_markdown_skeletons, populate_markdown_files
 from agent.create_presentation import create_feature_presentation, create_google_feature_presentation
 from tqdm import tqdm
 import argparse
 
-# Define cache directory
-CACHE_DIR = Path("cache")
-CACHE_DIR.mkdir(exist_ok=True)
+# Keyframe extraction settings; part of the keyframe cache key
+KEYFRAME_OPTIONS = dict(dedupe="global", revisits=True, analysis_width=512, keyframes_per_minute=None, sample_interval=DEFAULT_SAMPLE_INTERVAL, adaptive=False, change_detector="phash", mask_learn_seconds=0)
 
-def get_cache_path(name, video_path):
-    """Create a stable cache filename based on the video path"""
-    # Use the last part of the path (filename) instead of hash
-    video_name = Path(video_path).stem
-    # Remove any special characters and spaces
-    video_name = ''.join(c for c in video_name if c.isalnum())
-    # Limit the length of the video name
-    video_name = video_name[:32]
-    return CACHE_DIR / f"{name}_{video_name}.pkl"
-
-def load_from_cache(cache_path):
-    """Load data from cache if it exists"""
-    if cache_path.exists():
-        print(f"Loading from cache: {cache_path}")
-        with open(cache_path, 'rb') as f:
-            return pickle.load(f)
-    return None
-
-def save_to_cache(data, cache_path):
-    """Save data to cache"""
-    with open(cache_path, 'wb') as f:
-        pickle.dump(data, f)
-    print(f"Saved to cache: {cache_path}")
+def keyframes_cache_key(video_path, backend):
+    return cache_key("keyframes", file_digest(video_path), backend=backend, **KEYFRAME_OPTIONS)
 
 def process_audio(video_path, force=False):
-    """Extract audio from video"""
-    cache_path = get_cache_path("audio", video_path)
-    
-    if not force:
-        cached = load_from_cache(cache_path)
-        if cached:
-            return cached
-    
+    """Decode the audio track to 16 kHz PCM (not cached: it is large and only feeds the cached transcript)"""
     print("Extracting audio...")
-    audio_path = extract_audio(video_path)
-    save_to_cache(audio_path, cache_path)
-    return audio_path
+    return extract_audio_pcm(video_path)
+
+def process_transcript(video_path, force=False, audio=None):
+    """Transcribe audio (decoded here unless `audio` was already extracted)"""
+    key = cache_key("transcript", file_digest(video_path), model=DEFAULT_MODEL)
 
-def process_transcript(audio_path, force=False):
-    """Transcribe audio"""
-    cache_path = get_cache_path("transcript", audio_path)
-    
     if not force:
-        cached = load_from_cache(cache_path)
-        if cached:
-            return cached
-    
+        cached = cache_get(key)
+        if cached is not None:
+            # Entries written before the Transcript type are lists of segment dicts
+            return Transcript.coerce(cached)
+
+    if audio is None:
+        audio = process_audio(video_path, force=force)
     print("Transcribing...")
-    transcript = transcribe_audio(audio_path)
-    save_to_cache(transcript, cache_path)
+    transcript = transcribe_audio(audio)
+    cache_put(key, transcript)
     return transcript
 
-def process_keyframes(video_path, force=False):
+def process_keyframes(video_path, force=False, backend="opencv", output_dir="output/keyframes"):
     """Extract keyframes from video"""
-    cache_path = get_cache_path("keyframes", video_path)
-    
+    key = keyframes_cache_key(video_path, backend)
+
     if not force:
-        cached = load_from_cache(cache_path)
-        if cached:
-            return cached
-    
+        cached = cache_get(key)
+        # Images may have been cleaned up or written for another output directory
+        keyframes = cached and relocate_keyframes(cached, output_dir)
+        if keyframes:
+            return keyframes
+
     print("Extracting keyframes...")
-    keyframes = extract_keyframes(video_path)
-    save_to_cache(keyframes, cache_path)
+    # Adaptive sampling depends on the previous sample and runs in a single process
+    workers = 1 if KEYFRAME_OPTIONS["adaptive"] else os.cpu_count()
+    keyframes = extract_keyframes(video_path, output_dir=output_dir, workers=workers, backend=backend, **KEYFRAME_OPTIONS)
+    cache_put(key, keyframes)
     return keyframes
 
-def process_keyframe_summaries(keyframes, force=False):
+def process_keyframe_summaries(keyframes, video_path, force=False, backend="opencv", concurrency=8, batch_size=4):
     """Analyze keyframes and generate summaries"""
-    # Use a stable identifier for the keyframes based on their count
-    keyframes_id = f"keyframe_summaries_{len(keyframes)}"
-    cache_path = get_cache_path(keyframes_id, "keyframes")
-    
+    # Summaries depend only on the keyframes, which are determined by the video and extraction settings,
+    # and on whether context came from the previous summary (serial) or from the visual diff (concurrent)
+    key = cache_key("keyframe_summaries", keyframes_cache_key(video_path, backend), context="visual" if concurrency else "summary", batch_size=batch_size)
+
     if not force:
-        cached = load_from_cache(cache_path)
-        if cached:
+        cached = cache_get(key)
+        if cached is not None:
             return cached
-    
+
     print("Analyzing keyframes...")
-    keyframe_summaries = []
-    prev_context = None
-    for kf in tqdm(keyframes):
-        summary = summarize_keyframe(kf['path'], kf['timestamp'], previous_context=prev_context)
-        keyframe_summaries.append(summary)
-        # Use first 2 lines of this summary as context for the next keyframe
-        prev_context = '\n'.join(summary.splitlines()[:2])
-    
-    save_to_cache(keyframe_summaries, cache_path)
+    with tqdm(total=len(keyframes)) as pbar:
+        keyframe_summaries = summarize_keyframes(keyframes, on_progress=lambda idx, kf: pbar.update(1), concurrency=concurrency, batch_size=batch_size)
+
+    cache_put(key, keyframe_summaries)
     return keyframe_summaries
 
-def process_user_journey(keyframe_summaries, force=False, language=None):
+def process_user_journey(keyframe_summaries, force=False, language=None, window_size=40):
     """Consolidate keyframe summaries into a user journey"""
-    cache_path = get_cache_path("user_journey", str(len(keyframe_summaries)))
-    
+    key = cache_key("user_journey", text_digest(json.dumps(keyframe_summaries)), window_size=window_size)
+
     if not force:
-        cached = load_from_cache(cache_path)
-        if cached:
+        cached = cache_get(key)
+        if cached is not None:
             return cached
-    
+
     print("Consolidating user journey...")
-    user_journey_flow = consolidate_user_journey(keyframe_summaries)
-    save_to_cache(user_journey_flow, cache_path)
+    user_journey_flow = consolidate_user_journey(keyframe_summaries, window_size=window_size)
+    cache_put(key, user_journey_flow)
     return user_journey_flow
 
 def process_documentation(transcript, user_journey_flow, base_path="output/docs", force=False, language=None):
     """Generate documentation from transcript and user journey"""
-    cache_path = get_cache_path("folder_structure", str(hash(str(user_journey_flow))))
-    
-    if not force:
-        cached = load_from_cache(cache_path)
-        if cached and not force:
-            folder_structure = cached
-        else:
-            print("Generating documentation folder structure...")
-            folder_structure = generate_folder_structure(transcript, user_journey_flow, language=language)
-            save_to_cache(folder_structure, cache_path)
-    else:
+    key = cache_key("folder_structure", text_digest(json.dumps([transcript, user_journey_flow], default=str)), language=language)
+
+    folder_structure = None if force else cache_get(key)
+    if folder_structure is None:
         print("Generating documentation folder structure...")
         folder_structure = generate_folder_structure(transcript, user_journey_flow, language=language)
-        save_to_cache(folder_structure, cache_path)
-    
+        cache_put(key, folder_structure)
+
     print("Creating markdown skeletons...")
     generate_markdown_skeletons(folder_structure, user_journey_flow, base_path=base_path, language=language)
     
@@ -163,18 +129,42 @@ def main():
                         help='Specify which steps to run')
     parser.add_argument('--force', action='store_true', help='Force regeneration of cached data')
     parser.add_argument('--output', default='output', help='Output directory')
+    parser.add_argument('--keyframe-backend', default='opencv', choices=['opencv', 'ffmpeg'],
+                        help='Keyframe extraction backend (pHash over decoded frames, or ffmpeg scene detection)')
+    parser.add_argument('--adaptive-keyframes', action='store_true',
+                        help='Sample frames densely during visual activity and sparsely on static screens (uses a single process)')
+    parser.add_argument('--change-detector', default='phash', choices=['phash', 'tiles'],
+                        help='Keyframe change test: global pHash distance, or per-tile changes that ignore cursor and caret movement')
+    parser.add_argument('--mask-learn-seconds', type=float, default=0,
+                        help='With --change-detector tiles, mask tiles that keep changing during the first N seconds (clocks, spinners)')
+    parser.add_argument('--vision-concurrency', type=int, default=8,
+                        help='Vision requests in flight while analyzing keyframes (0 = one at a time, with the previous summary as context)')
+    parser.add_argument('--vision-batch-size', type=int, default=4,
+                        help='Consecutive keyframes analyzed per vision request')
+    parser.add_argument('--journey-window-size', type=int, default=40,
+                        help='Keyframe summaries per consolidation window; longer videos are consolidated hierarchically (0 = single prompt)')
+    parser.add_argument('--no-llm-cache', action='store_true',
+                        help='Always call the OpenAI API, even for requests answered before (--force alone still reuses cached responses)')
     
     args = parser.parse_args()
+    if args.no_llm_cache:
+        llm_cache.LLM_CACHE_ENABLED = False
+    KEYFRAME_OPTIONS.update(adaptive=args.adaptive_keyframes, change_detector=args.change_detector,
+                            mask_learn_seconds=args.mask_learn_seconds)
     
     # Create output directories
     output_dir = Path(args.output)
     docs_dir = output_dir / "docs"
     presentation_dir = output_dir / "presentation"
+    # Keyframes are namespaced per video (name plus content hash) so runs on different videos,
+    # even ones with the same file name, don't overwrite each other
+    keyframes_dir = output_dir / "keyframes" / f"{Path(args.video_path).stem}-{file_digest(args.video_path)[:12]}"
     docs_dir.mkdir(exist_ok=True, parents=True)
     presentation_dir.mkdir(exist_ok=True, parents=True)
     
     # Track what we've processed for use in later steps
     results = {}
+    audio = None
     
     # Run selected steps
     steps = args.steps
@@ -183,40 +173,37 @@ def main():
     
     for step in steps:
         if step == 'audio':
-            results['audio_path'] = process_audio(args.video_path, force=args.force)
+            audio = process_audio(args.video_path, force=args.force)
+            results['audio_seconds'] = len(audio) / SAMPLE_RATE
         
         elif step == 'transcript':
-            if 'audio_path' not in results:
-                results['audio_path'] = process_audio(args.video_path, force=args.force)
-            results['transcript'] = process_transcript(results['audio_path'], force=args.force)
+            results['transcript'] = process_transcript(args.video_path, force=args.force, audio=audio)
         
         elif step == 'keyframes':
-            results['keyframes'] = process_keyframes(args.video_path, force=args.force)
+            results['keyframes'] = process_keyframes(args.video_path, force=args.force, backend=args.keyframe_backend, output_dir=str(keyframes_dir))
         
         elif step == 'summaries':
             if 'keyframes' not in results:
-                results['keyframes'] = process_keyframes(args.video_path, force=args.force)
-            results['keyframe_summaries'] = process_keyframe_summaries(results['keyframes'], force=args.force)
+                results['keyframes'] = process_keyframes(args.video_path, force=args.force, backend=args.keyframe_backend, output_dir=str(keyframes_dir))
+            results['keyframe_summaries'] = process_keyframe_summaries(results['keyframes'], args.video_path, force=args.force, backend=args.keyframe_backend, concurrency=args.vision_concurrency, batch_size=args.vision_batch_size)
         
         elif step == 'journey':
             if 'keyframe_summaries' not in results:
                 if 'keyframes' not in results:
-                    results['keyframes'] = process_keyframes(args.video_path, force=args.force)
-                results['keyframe_summaries'] = process_keyframe_summaries(results['keyframes'], force=args.force)
-            results['user_journey'] = process_user_journey(results['keyframe_summaries'], force=args.force)
+                    results['keyframes'] = process_keyframes(args.video_path, force=args.force, backend=args.keyframe_backend, output_dir=str(keyframes_dir))
+                results['keyframe_summaries'] = process_keyframe_summaries(results['keyframes'], args.video_path, force=args.force, backend=args.keyframe_backend, concurrency=args.vision_concurrency, batch_size=args.vision_batch_size)
+            results['user_journey'] = process_user_journey(results['keyframe_summaries'], force=args.force, window_size=args.journey_window_size)
         
         elif step == 'docs':
             if 'transcript' not in results:
-                if 'audio_path' not in results:
-                    results['audio_path'] = process_audio(args.video_path, force=args.force)
-                results['transcript'] = process_transcript(results['audio_path'], force=args.force)
+                results['transcript'] = process_transcript(args.video_path, force=args.force, audio=audio)
             
             if 'user_journey' not in results:
                 if 'keyframe_summaries' not in results:
                     if 'keyframes' not in results:
-                        results['keyframes'] = process_keyframes(args.video_path, force=args.force)
-                    results['keyframe_summaries'] = process_keyframe_summaries(results['keyframes'], force=args.force)
-                results['user_journey'] = process_user_journey(results['keyframe_summaries'], force=args.force)
+                        results['keyframes'] = process_keyframes(args.video_path, force=args.force, backend=args.keyframe_backend, output_dir=str(keyframes_dir))
+                    results['keyframe_summaries'] = process_keyframe_summaries(results['keyframes'], args.video_path, force=args.force, backend=args.keyframe_backend, concurrency=args.vision_concurrency, batch_size=args.vision_batch_size)
+                results['user_journey'] = process_user_journey(results['keyframe_summaries'], force=args.force, window_size=args.journey_window_size)
             
             docs_path = process_documentation(
                 results['transcript'], 
@@ -230,16 +217,16 @@ def main():
         elif step == 'presentation':
             if 'keyframe_summaries' not in results:
                 if 'keyframes' not in results:
-                    results['keyframes'] = process_keyframes(args.video_path, force=args.force)
-                results['keyframe_summaries'] = process_keyframe_summaries(results['keyframes'], force=args.force)
+                    results['keyframes'] = process_keyframes(args.video_path, force=args.force, backend=args.keyframe_backend, output_dir=str(keyframes_dir))
+                results['keyframe_summaries'] = process_keyframe_summaries(results['keyframes'], args.video_path, force=args.force, backend=args.keyframe_backend, concurrency=args.vision_concurrency, batch_size=args.vision_batch_size)
             
             if 'user_journey' not in results:
-                results['user_journey'] = process_user_journey(results['keyframe_summaries'], force=args.force)
+                results['user_journey'] = process_user_journey(results['keyframe_summaries'], force=args.force, window_size=args.journey_window_size)
             
             if 'keyframes' not in results:
-                results['keyframes'] = process_keyframes(args.video_path, force=args.force)
+                results['keyframes'] = process_keyframes(args.video_path, force=args.force, backend=args.keyframe_backend, output_dir=str(keyframes_dir))
             
-            keyframe_paths = [kf['path'] for kf in results['keyframes']]
+            keyframe_paths = [kf['path'] for kf in results['keyframes'] if kf.get('revisit_of') is None]
             presentation_path = create_presentation(
                 results['keyframe_summaries'],
                 results['user_journey'],
@@ -254,7 +241,11 @@ def main():
     with open(output_dir / "process_summary.json", 'w') as f:
         summary = {k: str(v) if not isinstance(v, (str, int, float, bool, list, dict, type(None))) else v 
                   for k, v in results.items()}
+        # In-memory analysis JPEGs aren't JSON serializable; the paths are enough
+        if 'keyframes' in summary:
+            summary['keyframes'] = [{k: v for k, v in kf.items() if k != 'image'} for kf in summary['keyframes']]
         json.dump(summary, f, indent=2)
+    print(f"LLM cache: {llm_cache.cache_stats()}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
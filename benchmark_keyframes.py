@@ -0,0 +1,42 @@
+import argparse
+import shutil
+import tempfile
+import time
+from preprocess.keyframes import extract_keyframes
+
+def run_backend(video_path, backend, runs):
+    """Run one keyframe backend `runs` times on a scratch directory; returns (best_seconds, keyframes)."""
+    best = None
+    keyframes = []
+    for _ in range(runs):
+        out_dir = tempfile.mkdtemp(prefix=f"kf_{backend}_")
+        try:
+            start = time.perf_counter()
+            keyframes = extract_keyframes(video_path, output_dir=out_dir, backend=backend)
+            elapsed = time.perf_counter() - start
+        finally:
+            shutil.rmtree(out_dir, ignore_errors=True)
+        best = elapsed if best is None else min(best, elapsed)
+    return best, keyframes
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare keyframe extraction backends on the same video.')
+    parser.add_argument('video_path', help='Path to the video file')
+    parser.add_argument('--runs', type=int, default=3, help='Runs per backend (best time is reported)')
+    parser.add_argument('--backends', nargs='+', default=['opencv', 'ffmpeg'], choices=['opencv', 'ffmpeg'])
+    args = parser.parse_args()
+
+    results = {}
+    for backend in args.backends:
+        seconds, keyframes = run_backend(args.video_path, backend, args.runs)
+        results[backend] = keyframes
+        print(f"{backend:>8}: {seconds:.2f}s, {len(keyframes)} keyframes")
+
+    if len(results) == 2:
+        a, b = (set(kf['timestamp'] for kf in results[name]) for name in args.backends)
+        print(f"Shared timestamps: {len(a & b)} / {len(a | b)}")
+        print(f"Only {args.backends[0]}: {sorted(a - b)}")
+        print(f"Only {args.backends[1]}: {sorted(b - a)}")
+
+if __name__ == "__main__":
+    main()
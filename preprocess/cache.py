@@ -0,0 +1,118 @@
+import os
+import json
+import pickle
+import shutil
+import hashlib
+import threading
+from preprocess.storage import atomic_write_bytes
+
+# Shared by the CLI and the API; entries are pickles named by their key
+CACHE_DIR = os.getenv("CACHE_DIR", "cache")
+# The least recently used entries are deleted once the cache grows past this size
+CACHE_MAX_MB = float(os.getenv("CACHE_MAX_MB", 2048))
+# Bump to invalidate every entry when the format of cached results changes
+CACHE_VERSION = 1
+HASH_CHUNK = 1 << 20
+
+# (path, size, mtime) -> sha256, so a file is read only once per process
+_DIGESTS = {}
+_EVICT_LOCK = threading.Lock()
+
+def file_digest(path):
+    """Streaming SHA-256 of a file's contents; identical re-uploads get the same digest whatever their name."""
+    st = os.stat(path)
+    memo_key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    digest = _DIGESTS.get(memo_key)
+    if digest is None:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(HASH_CHUNK), b""):
+                h.update(block)
+        digest = _DIGESTS[memo_key] = h.hexdigest()
+    return digest
+
+def text_digest(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def cache_key(kind, digest, **params):
+    """Key for the result of step `kind` on content `digest` computed with `params` (model, thresholds, ...)."""
+    payload = json.dumps({"kind": kind, "digest": digest, "params": params, "version": CACHE_VERSION},
+                         sort_keys=True, default=str)
+    return f"{kind}-{hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]}"
+
+def _entry_path(key):
+    return os.path.join(CACHE_DIR, f"{key}.pkl")
+
+def cache_get(key):
+    """Return the cached value for `key`, or None. A hit marks the entry as recently used."""
+    path = _entry_path(key)
+    try:
+        with open(path, "rb") as f:
+            value = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"[WARN] Dropping unreadable cache entry {path}: {e}")
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    print(f"Loading from cache: {path}")
+    return value
+
+def cache_put(key, value):
+    path = _entry_path(key)
+    atomic_write_bytes(path, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+    print(f"Saved to cache: {path}")
+    evict()
+
+def cache_iter(key, items):
+    """Yield from `items` and cache the full list once it is exhausted, so streaming consumers still populate the cache."""
+    collected = []
+    for item in items:
+        collected.append(item)
+        yield item
+    cache_put(key, collected)
+
+def evict(max_mb=None):
+    """Delete least recently used entries until the cache fits in `max_mb` (default CACHE_MAX_MB)."""
+    max_bytes = (CACHE_MAX_MB if max_mb is None else max_mb) * 2**20
+    with _EVICT_LOCK:
+        entries = []
+        for entry in os.scandir(CACHE_DIR):
+            if entry.is_file() and entry.name.endswith(".pkl"):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+def relocate_keyframes(keyframes, output_dir):
+    """
+    Point cached keyframes at `output_dir`, copying the images over if they were saved for another job.
+    Returns None if any image no longer exists, in which case the entry should be recomputed.
+    """
+    if any(kf["path"] and not os.path.exists(kf["path"]) for kf in keyframes):
+        return None
+    os.makedirs(output_dir, exist_ok=True)
+    relocated = []
+    for kf in keyframes:
+        if not kf["path"]:
+            relocated.append(kf)
+            continue
+        path = os.path.join(output_dir, os.path.basename(kf["path"]))
+        if os.path.abspath(path) != os.path.abspath(kf["path"]):
+            shutil.copy2(kf["path"], path)
+        relocated.append({**kf, "path": path})
+    return relocated
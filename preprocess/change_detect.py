@@ -0,0 +1,89 @@
+import cv2
+import numpy as np
+
+# Each tile is reduced to an 8x8 grayscale thumbnail
+TILE_PX = 8
+# Thumbnail pixels must exceed the tile mean by this much to set a hash bit, so flat tiles hash stably
+AHASH_MARGIN = 4
+# A tile counts as changed if more hash bits than this flip, or its mean brightness moves this much,
+# provided its pixels also moved by TILE_MIN_MAD on average (hash bits of low-contrast tiles flip on noise)
+TILE_BITS = 3
+TILE_MEAN_DIFF = 6.0
+TILE_MIN_MAD = 2.0
+# Fraction of the unmasked tiles that must change for a new keyframe
+MIN_CHANGED_FRACTION = 0.03
+# During mask learning, tiles that changed in more than this fraction of the one-second intervals are masked
+MASK_FLICKER_FRACTION = 0.5
+
+def tile_signature(frame, grid=(16, 16)):
+    """
+    Per-tile average hashes for a BGR frame split into a rows x cols grid.
+    Returns (hashes, means, thumbs): packed hash bits ((rows*cols, 8) uint8), mean brightness
+    per tile, and the 8x8 tile thumbnails themselves ((rows*cols, 64) uint8).
+    """
+    rows, cols = grid
+    small = cv2.resize(frame, (cols * TILE_PX, rows * TILE_PX), interpolation=cv2.INTER_AREA)
+    if small.ndim == 3:
+        small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    tiles = small.reshape(rows, TILE_PX, cols, TILE_PX).transpose(0, 2, 1, 3).reshape(rows * cols, -1).astype(np.float32)
+    means = tiles.mean(axis=1)
+    bits = tiles > (means[:, None] + AHASH_MARGIN)
+    return np.packbits(bits, axis=1), means, tiles.astype(np.uint8)
+
+class TiledChangeDetector:
+    """
+    Decides whether two frames differ by a meaningful UI state change rather than cursor movement,
+    a blinking caret or a ticking clock.
+
+    Frames are compared tile by tile (see tile_signature); the change counts only if at least
+    `min_changed_fraction` of the unmasked tiles changed. With `learn_seconds`, tiles that keep
+    changing during the first `learn_seconds` of video (clocks, spinners, animated thumbnails),
+    i.e. change within most one-second intervals, are masked out for the rest of it.
+    """
+
+    def __init__(self, grid=(16, 16), min_changed_fraction=MIN_CHANGED_FRACTION, learn_seconds=0):
+        self.grid = grid
+        self.min_changed_fraction = min_changed_fraction
+        self.learn_seconds = learn_seconds
+        n_tiles = grid[0] * grid[1]
+        self.mask = np.ones(n_tiles, dtype=bool)
+        self.learning = learn_seconds > 0
+        self.change_counts = np.zeros(n_tiles, dtype=np.int32)
+        self.intervals = 0
+        self.interval = None
+        self.interval_changed = np.zeros(n_tiles, dtype=bool)
+        self.last_signature = None
+
+    def changed_tiles(self, a, b):
+        hashes_a, means_a, thumbs_a = a
+        hashes_b, means_b, thumbs_b = b
+        bit_diff = np.unpackbits(hashes_a ^ hashes_b, axis=1).sum(axis=1)
+        mad = np.abs(thumbs_a.astype(np.int16) - thumbs_b).mean(axis=1)
+        return ((bit_diff > TILE_BITS) | (np.abs(means_a - means_b) > TILE_MEAN_DIFF)) & (mad > TILE_MIN_MAD)
+
+    def observe(self, sec, signature):
+        """Feed consecutive samples in order; learns the static mask during the first `learn_seconds`."""
+        if not self.learning:
+            return
+        interval = int(sec)
+        if interval != self.interval:
+            if self.interval is not None:
+                self.change_counts += self.interval_changed
+                self.intervals += 1
+            self.interval = interval
+            self.interval_changed[:] = False
+        if sec >= self.learn_seconds:
+            if self.intervals:
+                self.mask = self.change_counts / self.intervals <= MASK_FLICKER_FRACTION
+            self.learning = False
+            return
+        if self.last_signature is not None:
+            self.interval_changed |= self.changed_tiles(self.last_signature, signature)
+        self.last_signature = signature
+
+    def changed(self, a, b):
+        active = self.mask.sum()
+        if not active:
+            return False
+        fraction = (self.changed_tiles(a, b) & self.mask).sum() / active
+        return fraction >= self.min_changed_fraction
@@ -1,5 +1,43 @@
+import os
+import tempfile
 import subprocess
+import numpy as np
+from preprocess.scratch import scratch_root
 
-def extract_audio(video_path, audio_path="temp_audio.wav"):
+# Whisper works on 16 kHz mono audio
+SAMPLE_RATE = 16000
+
+def extract_audio(video_path, audio_path=None):
+    """
+    Write the audio track of `video_path` to `audio_path`. Without a path, a uniquely named WAV is
+    created under the scratch root (see preprocess.scratch) and the caller is responsible for
+    removing it; pass a path inside job_scratch() to have it cleaned up with the job.
+    """
+    if audio_path is None:
+        fd, audio_path = tempfile.mkstemp(prefix="audio-", suffix=".wav", dir=scratch_root())
+        os.close(fd)
     subprocess.run(["ffmpeg", "-i", video_path, "-q:a", "0", "-map", "a", audio_path, "-y"])
     return audio_path
+
+def extract_audio_pcm(video_path, sample_rate=SAMPLE_RATE, allow_truncated=False, start=0.0):
+    """
+    Decode the audio track of `video_path` straight to mono float32 PCM at `sample_rate`, read
+    from ffmpeg's stdout into memory. The array can be passed to transcribe_audio as is, so Whisper
+    skips its own ffmpeg decode and no temporary WAV is written.
+
+    With `allow_truncated`, a file that is still being written (ffmpeg fails on its incomplete end)
+    yields whatever audio could be decoded instead of raising. `start` (seconds) skips the audio
+    before it without decoding it.
+    """
+    seek = ["-ss", f"{start:.3f}"] if start else []
+    proc = subprocess.Popen(
+        ["ffmpeg", "-nostdin", "-loglevel", "error", "-threads", "0", *seek, "-i", video_path, "-map", "a:0", "-vn",
+         "-f", "f32le", "-ac", "1", "-ar", str(sample_rate), "-"],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    # communicate() drains stdout and stderr together; reading them one after the other deadlocks
+    # once ffmpeg fills the stderr pipe (e.g. many decode errors on a truncated upload)
+    buf, stderr = proc.communicate()
+    if proc.returncode != 0 and not (allow_truncated and buf):
+        raise RuntimeError(f"ffmpeg audio decode failed: {stderr.decode(errors='replace')[-500:]}")
+    return np.frombuffer(buf[:len(buf) - len(buf) % 4], dtype=np.float32)
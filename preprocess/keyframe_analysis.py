@@ -1,16 +1,27 @@
 import openai
+from preprocess.llm_cache import chat_completion, chat_completion_async
 import os
 import base64
-from typing import List
+from typing import Iterable, List, Union
 
 # Summarize a single keyframe image using OpenAI Vision
 
 from PIL import Image
 import io
+import numpy as np
 
-def summarize_keyframe(image_path: str, timestamp: str, openai_model: str = "gpt-4o-mini", previous_context: str = None) -> str:
+def _analysis_jpeg(image: Union[str, bytes, "np.ndarray"]) -> bytes:
+    """
+    JPEG bytes (<=512px wide) to send to the vision model. Bytes are taken to be an analysis JPEG
+    already (see extract_keyframes(analysis_width=512)), an ndarray is a BGR frame, a str is a path.
+    """
+    if isinstance(image, (bytes, bytearray)):
+        return bytes(image)
+    if hasattr(image, "shape"):
+        from preprocess.keyframes import encode_analysis_jpeg
+        return encode_analysis_jpeg(image, 512)
     # Resize image to width=512px, maintain aspect ratio
-    img = Image.open(image_path)
+    img = Image.open(image)
     w, h = img.size
     if w > 512:
         new_h = int(h * 512 / w)
@@ -18,8 +29,10 @@ def summarize_keyframe(image_path: str, timestamp: str, openai_model: str = "gpt
     # Save to JPEG in-memory
     buf = io.BytesIO()
     img.convert("RGB").save(buf, format="JPEG", quality=85)
-    img_bytes = buf.getvalue()
-    img_b64 = base64.b64encode(img_bytes).decode("utf-8")
+    return buf.getvalue()
+
+def _keyframe_messages(image, timestamp, previous_context=None):
+    img_b64 = base64.b64encode(_analysis_jpeg(image)).decode("utf-8")
     image_url = f"data:image/jpeg;base64,{img_b64}"
     context_instruction = ""
     if previous_context:
@@ -27,38 +40,34 @@ def summarize_keyframe(image_path: str, timestamp: str, openai_model: str = "gpt
     else:
         context_instruction = ""
 
-    response = openai.chat.completions.create(
-        model=openai_model,
-        messages=[
-            {"role": "system", "content": "You are an expert at analyzing UI screenshots and describing user actions and application state."},
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": f"""Analyze the application screenshot provided.
-
-                        **Instructions:**
-                        1.  Start your response *immediately* with the timestamp in [mm:ss] format: {timestamp}
-                        2.  Describe the primary user action or application state visible.
-                        3.  Mention key visible UI elements involved (buttons, menus, fields).
-                        4.  Note any apparent transitions or changes from a previous state (if applicable, based on the context below).
-                        5.  Be concise and focus only on what is visible.
-
-                        **Timestamp:** {timestamp}
-                        {context_instruction}"""
-                    },
-                    {"type": "image_url", "image_url": {"url": image_url}}
-                ]
-            }
-        ],
-        max_tokens=200 # Keep max_tokens or adjust if needed
-    )
-    summary = response.choices[0].message.content.strip()
-    # The check 'if not summary.startswith(timestamp):' might become redundant
-    # if the model consistently follows the new instruction 1. Can be kept for safety.
-    # Ensure timestamp is present at the start (Safety check)
-    if not summary.startswith(f"[{timestamp.split(':')[0]}:{timestamp.split(':')[1]}]"): # Check format [mm:ss]
+    return [
+        {"role": "system", "content": "You are an expert at analyzing UI screenshots and describing user actions and application state."},
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": f"""Analyze the application screenshot provided.
+
+                    **Instructions:**
+                    1.  Start your response *immediately* with the timestamp in [mm:ss] format: {timestamp}
+                    2.  Describe the primary user action or application state visible.
+                    3.  Mention key visible UI elements involved (buttons, menus, fields).
+                    4.  Note any apparent transitions or changes from a previous state (if applicable, based on the context below).
+                    5.  Be concise and focus only on what is visible.
+
+                    **Timestamp:** {timestamp}
+                    {context_instruction}"""
+                },
+                {"type": "image_url", "image_url": {"url": image_url}}
+            ]
+        }
+    ]
+
+def _ensure_timestamp(summary, timestamp):
+    # Ensure the [mm:ss] timestamp is present at the start (safety check in case the model ignores instruction 1)
+    tag = timestamp if timestamp.startswith("[") else f"[{timestamp}]"
+    if not summary.startswith(tag):
          # Attempt to find timestamp pattern if not at start
          import re
          match = re.search(r"\[\d{1,2}:\d{2}\]", summary)
@@ -68,14 +77,311 @@ def summarize_keyframe(image_path: str, timestamp: str, openai_model: str = "gpt
              summary = ts + " " + summary.replace(ts, "").strip()
          else:
              # If not found at all, prepend it
-             summary = f"[{timestamp.split(':')[0]}:{timestamp.split(':')[1]}] {summary}"
+             summary = f"{tag} {summary}"
 
     return summary
 
+def summarize_keyframe(image: Union[str, bytes, "np.ndarray"], timestamp: str, openai_model: str = "gpt-4o-mini", previous_context: str = None) -> str:
+    response = chat_completion(
+        model=openai_model,
+        messages=_keyframe_messages(image, timestamp, previous_context),
+        max_tokens=200 # Keep max_tokens or adjust if needed
+    )
+    return _ensure_timestamp(response.choices[0].message.content.strip(), timestamp)
+
+async def summarize_keyframe_async(client, image: Union[str, bytes, "np.ndarray"], timestamp: str, openai_model: str = "gpt-4o-mini", previous_context: str = None) -> str:
+    """summarize_keyframe on an `openai.AsyncOpenAI` client."""
+    response = await chat_completion_async(
+        client,
+        model=openai_model,
+        messages=_keyframe_messages(image, timestamp, previous_context),
+        max_tokens=200
+    )
+    return _ensure_timestamp(response.choices[0].message.content.strip(), timestamp)
+
+# Summarize several consecutive keyframes in one request
+
+def _image_part(image):
+    img_b64 = base64.b64encode(_analysis_jpeg(image)).decode("utf-8")
+    return {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{img_b64}"}}
+
+def _batch_messages(items):
+    """Messages for one request covering `items` = [(image, timestamp, context), ...] in order."""
+    timestamps = ", ".join(ts for _, ts, _ in items)
+    content = [{
+        "type": "text",
+        "text": f"""Analyze the {len(items)} consecutive application screenshots below, taken at {timestamps}.
+
+        **Instructions (for each screenshot):**
+        1.  Start its summary with its timestamp in [mm:ss] format.
+        2.  Describe the primary user action or application state visible.
+        3.  Mention key visible UI elements involved (buttons, menus, fields).
+        4.  Note any apparent transitions or changes from the previous screenshot or the context given.
+        5.  Be concise and focus only on what is visible.
+
+        Return ONLY a JSON object mapping each timestamp exactly as given (e.g. "{items[0][1]}") to its summary."""
+    }]
+    for i, (image, timestamp, context) in enumerate(items, 1):
+        text = f"Screenshot {i} of {len(items)}, timestamp {timestamp}"
+        if context:
+            text += f"\n**Context:** {context}"
+        content.append({"type": "text", "text": text})
+        content.append(_image_part(image))
+    return [
+        {"role": "system", "content": "You are an expert at analyzing UI screenshots and describing user actions and application state."},
+        {"role": "user", "content": content}
+    ]
+
+def _parse_batch(content, items):
+    """Per-item summaries from a batch response; None where the response has no usable entry."""
+    import json
+    try:
+        data = json.loads(content)
+    except (TypeError, ValueError):
+        return [None] * len(items)
+    if not isinstance(data, dict):
+        return [None] * len(items)
+    summaries = []
+    for _, timestamp, _ in items:
+        summary = data.get(timestamp, data.get(timestamp.strip("[]")))
+        summaries.append(_ensure_timestamp(summary.strip(), timestamp) if isinstance(summary, str) and summary.strip() else None)
+    return summaries
+
+def _batchable(items):
+    # Responses are keyed by timestamp, so a batch can't hold two frames from the same second
+    return len(items) > 1 and len({ts for _, ts, _ in items}) == len(items)
+
+def summarize_keyframe_batch(items, openai_model: str = "gpt-4o-mini") -> List[str]:
+    """
+    Summarize `items` = [(image, timestamp, previous_context), ...] with a single vision request that
+    returns JSON keyed by timestamp. Frames missing from an unparseable or incomplete response are
+    summarized one by one with summarize_keyframe.
+    """
+    parsed = [None] * len(items)
+    if _batchable(items):
+        response = chat_completion(
+            model=openai_model,
+            messages=_batch_messages(items),
+            response_format={"type": "json_object"},
+            max_tokens=200 * len(items),
+            validate=lambda r: None not in _parse_batch(r.choices[0].message.content, items)
+        )
+        parsed = _parse_batch(response.choices[0].message.content, items)
+        if None in parsed:
+            print(f"[WARN] Batch response covered {len(items) - parsed.count(None)}/{len(items)} keyframes, retrying the rest individually")
+    return [summary or summarize_keyframe(image, timestamp, openai_model, context)
+            for summary, (image, timestamp, context) in zip(parsed, items)]
+
+async def summarize_keyframe_batch_async(client, items, openai_model: str = "gpt-4o-mini") -> List[str]:
+    """summarize_keyframe_batch on an `openai.AsyncOpenAI` client; fallback calls run concurrently."""
+    import asyncio
+    parsed = [None] * len(items)
+    if _batchable(items):
+        response = await chat_completion_async(
+            client,
+            model=openai_model,
+            messages=_batch_messages(items),
+            response_format={"type": "json_object"},
+            max_tokens=200 * len(items),
+            validate=lambda r: None not in _parse_batch(r.choices[0].message.content, items)
+        )
+        parsed = _parse_batch(response.choices[0].message.content, items)
+        if None in parsed:
+            print(f"[WARN] Batch response covered {len(items) - parsed.count(None)}/{len(items)} keyframes, retrying the rest individually")
+
+    async def one(summary, image, timestamp, context):
+        return summary or await summarize_keyframe_async(client, image, timestamp, openai_model, context)
+    return list(await asyncio.gather(*(one(summary, *item) for summary, item in zip(parsed, items))))
+
+def _revisit_summary(kf, earlier, earlier_summary):
+    import re
+    body = re.sub(r"^\[\d{1,2}:\d{2}\]\s*", "", earlier_summary)
+    return f"{kf['timestamp']} (Returns to the screen shown at {earlier['timestamp']}) {body}"
+
+def visual_context(prev_kf, kf):
+    """
+    Context for a keyframe derived from extraction alone (no earlier LLM output): the previous
+    keyframe's timestamp and how much the screen changed since, from the pHash distance ("change").
+    """
+    if prev_kf is None:
+        return "This is the first screen of the recording."
+    change = kf.get("change")
+    if change is None:
+        extent = "The screen changed"
+    elif change <= 16:
+        extent = "Part of the same screen changed (e.g. a field, menu or dialog)"
+    elif change <= 26:
+        extent = "Much of the screen changed"
+    else:
+        extent = "The view changed almost completely (likely a different page or application)"
+    return f"{extent} since the previous keyframe at {prev_kf['timestamp']}."
+
+# Summarize a sequence of keyframes, carrying context from one to the next
+
+def summarize_keyframes(keyframes: Iterable[dict], openai_model: str = "gpt-4o-mini", on_progress=None, concurrency: int = None, batch_size: int = 1) -> List[str]:
+    """
+    Summarize keyframes in order, passing the first two lines of each summary as context for the next.
+    Keyframes that revisit an earlier screen (`revisit_of`, see extract_keyframes(revisits=True)) reuse
+    that keyframe's summary under their own timestamp instead of making another vision call.
+    `keyframes` may be a generator (e.g. stream_keyframes) so analysis starts before extraction ends.
+    `on_progress(idx, keyframe)` is called before each keyframe is handled.
+
+    With `batch_size` > 1, up to that many consecutive new keyframes share one request (see
+    summarize_keyframe_batch); the context passed along is then the last summary of the previous batch.
+
+    With `concurrency`, up to that many vision requests are in flight at once (see
+    summarize_keyframes_concurrent); context then comes from visual_context instead of the previous summary.
+    """
+    if concurrency:
+        import asyncio
+        return asyncio.run(summarize_keyframes_concurrent(keyframes, openai_model, on_progress, concurrency, batch_size))
+    seen = []
+    summaries = []
+    pending = []
+    prev_context = None
+
+    def flush():
+        nonlocal prev_context
+        if not pending:
+            return
+        items = [(seen[i].get("image") or seen[i]['path'], seen[i]['timestamp'], prev_context if j == 0 else None)
+                 for j, i in enumerate(pending)]
+        for i, summary in zip(pending, summarize_keyframe_batch(items, openai_model)):
+            summaries[i] = summary
+        prev_context = '\n'.join(summaries[pending[-1]].splitlines()[:2])
+        pending.clear()
+
+    for idx, kf in enumerate(keyframes):
+        seen.append(kf)
+        summaries.append(None)
+        if on_progress:
+            on_progress(idx, kf)
+        if kf.get("revisit_of") is not None:
+            flush()
+            summaries[idx] = _revisit_summary(kf, seen[kf["revisit_of"]], summaries[kf["revisit_of"]])
+            prev_context = '\n'.join(summaries[idx].splitlines()[:2])
+        else:
+            pending.append(idx)
+            if len(pending) >= batch_size:
+                flush()
+    flush()
+    return summaries
+
+async def summarize_keyframes_concurrent(keyframes: Iterable[dict], openai_model: str = "gpt-4o-mini", on_progress=None, concurrency: int = 8, batch_size: int = 1) -> List[str]:
+    """
+    Concurrent summarize_keyframes on the async OpenAI client, with at most `concurrency` requests
+    in flight. Each keyframe gets visual_context (previous keyframe's timestamp and pHash change)
+    instead of the previous LLM summary, so no request waits on another and N keyframes take roughly
+    N / (concurrency * batch_size) round-trips. Keyframes are pulled from `keyframes` (which may be a
+    blocking generator such as stream_keyframes) in a worker thread; summaries are returned in order.
+    """
+    import asyncio
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    it = iter(keyframes)
+    done = object()
+
+    # Retries are left to preprocess.llm_scheduler
+    async with openai.AsyncOpenAI(max_retries=0) as client:
+        async def analyze(batch):
+            items = [(kf.get("image") or kf['path'], kf['timestamp'], context) for kf, context, _ in batch]
+            try:
+                async with semaphore:
+                    batch_summaries = await summarize_keyframe_batch_async(client, items, openai_model)
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                return
+            for (_, _, future), summary in zip(batch, batch_summaries):
+                future.set_result(summary)
+
+        async def revisit(kf, earlier, earlier_future):
+            return _revisit_summary(kf, earlier, await earlier_future)
+
+        seen = []
+        results = []
+        tasks = []
+        batch = []
+        try:
+            while True:
+                kf = await loop.run_in_executor(None, next, it, done)
+                if kf is done:
+                    break
+                if on_progress:
+                    on_progress(len(seen), kf)
+                if kf.get("revisit_of") is not None:
+                    result = asyncio.ensure_future(revisit(kf, seen[kf["revisit_of"]], results[kf["revisit_of"]]))
+                    tasks.append(result)
+                else:
+                    result = loop.create_future()
+                    batch.append((kf, visual_context(seen[-1] if seen else None, kf), result))
+                    if len(batch) >= batch_size:
+                        tasks.append(asyncio.ensure_future(analyze(batch)))
+                        batch = []
+                seen.append(kf)
+                results.append(result)
+            if batch:
+                tasks.append(asyncio.ensure_future(analyze(batch)))
+            await asyncio.gather(*tasks)
+            return [result.result() for result in results]
+        except BaseException:
+            for task in tasks + results:
+                task.cancel()
+            raise
+
 # Consolidate all keyframe summaries into a user journey flow
 
-def consolidate_user_journey(summaries: List[str]) -> str:
-    system_prompt = "You are an outcome-oriented product educator and UX analyst, skilled at creating clear, practical 'How-To' guides from application usage summaries."
+JOURNEY_SYSTEM_PROMPT = "You are an outcome-oriented product educator and UX analyst, skilled at creating clear, practical 'How-To' guides from application usage summaries."
+# Partial journeys merged per reduce call in hierarchical consolidation
+JOURNEY_REDUCE_FANIN = 4
+
+def consolidate_user_journey(summaries: List[str], window_size: int = None, max_workers: int = 8) -> str:
+    """
+    Turn keyframe summaries into a numbered How-To guide.
+
+    With `window_size`, videos with more summaries than that are consolidated map-reduce style:
+    windows of `window_size` summaries are turned into partial guides in parallel, then partial
+    guides are merged JOURNEY_REDUCE_FANIN at a time until one guide is left. Each prompt stays
+    small, and latency grows with the number of reduce rounds rather than with the video length.
+    """
+    if not window_size or len(summaries) <= window_size:
+        return _consolidate_window(summaries)
+    from concurrent.futures import ThreadPoolExecutor
+    from preprocess.llm_scheduler import with_current_priority
+    consolidate, merge = with_current_priority(_consolidate_window), with_current_priority(_merge_journeys)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        windows = [(summaries[i:i + window_size], i + 1) for i in range(0, len(summaries), window_size)]
+        parts = list(pool.map(lambda w: consolidate(*w), windows))
+        while len(parts) > 1:
+            groups = [parts[i:i + JOURNEY_REDUCE_FANIN] for i in range(0, len(parts), JOURNEY_REDUCE_FANIN)]
+            parts = list(pool.map(lambda g: g[0] if len(g) == 1 else merge(g, final=len(groups) == 1), groups))
+    return parts[0]
+
+def _merge_journeys(parts: List[str], final: bool) -> str:
+    """Reduce step: merge consecutive partial guides (in video order) into one."""
+    scope = "the complete" if final else "one combined partial"
+    instruction_prompt = f"""
+Below are {len(parts)} partial 'How-To User Journey Guides', each covering a consecutive part of the same application demo, in order.
+
+Merge them into {scope} guide:
+1.  Keep the chronological order and renumber the steps from 1.
+2.  Merge steps that repeat the same action or screen across parts; drop repetition.
+3.  {"Start with a brief description of the overall workflow and the main practical outcomes, then the main use cases." if final else "Keep only the numbered steps; the overview is written in the final merge."}
+4.  Keep the exact step format used in the parts (Use Case, Visible Elements, Guidance/Outcome).
+"""
+    input_data = "\n\n".join(f"---\n**Part {i}:**\n{part}" for i, part in enumerate(parts, 1))
+    response = chat_completion(
+        model="gpt-4o",
+        messages=[
+            {"role": "system", "content": JOURNEY_SYSTEM_PROMPT},
+            {"role": "user", "content": instruction_prompt + "\n" + input_data + "\n\n---\n**Merged How-To User Journey Guide:**"}
+        ],
+        max_tokens=3000 if final else 2000
+    )
+    return response.choices[0].message.content
+
+def _consolidate_window(summaries: List[str], start: int = 1) -> str:
+    system_prompt = JOURNEY_SYSTEM_PROMPT
 
     instruction_prompt = """
 Based on the provided step-wise summaries from key application screenshots, create a clear, numbered 'How-To User Journey Guide'.
@@ -105,11 +411,11 @@ Based on the provided step-wise summaries from key application screenshots, crea
 """
 
     # Append numbered summaries to the instruction prompt
-    input_data = "\n".join([f"{i}. {summary}" for i, summary in enumerate(summaries, 1)])
+    input_data = "\n".join([f"{i}. {summary}" for i, summary in enumerate(summaries, start)])
 
     full_user_prompt = instruction_prompt + "\n" + input_data + "\n\n---\n**How-To User Journey Guide:**"
 
-    response = openai.chat.completions.create(
+    response = chat_completion(
         model="gpt-4o", # Keep model or adjust
         messages=[
             {"role": "system", "content": system_prompt},
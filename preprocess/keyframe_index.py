@@ -0,0 +1,48 @@
+from preprocess.phash import hamming
+
+class BKTree:
+    """
+    BK-tree over 64-bit perceptual hashes with Hamming distance as the metric.
+
+    Lets keyframe extraction ask "is any earlier keyframe within `radius` bits of this frame?"
+    without comparing against every keyframe seen so far.
+    """
+
+    def __init__(self):
+        # Nodes are [hash, value, {distance: child_node}]
+        self.root = None
+        self.size = 0
+
+    def add(self, h, value):
+        self.size += 1
+        if self.root is None:
+            self.root = [h, value, {}]
+            return
+        node = self.root
+        while True:
+            d = hamming(h, node[0])
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [h, value, {}]
+                return
+            node = child
+
+    def nearest(self, h, radius):
+        """Return (distance, value) of the closest stored hash within `radius`, or None."""
+        if self.root is None:
+            return None
+        best = None
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            d = hamming(h, node[0])
+            if d <= radius and (best is None or d < best[0]):
+                best = (d, node[1])
+            # Triangle inequality: only children at distance in [d - radius, d + radius] can match
+            for child_d, child in node[2].items():
+                if d - radius <= child_d <= d + radius:
+                    stack.append(child)
+        return best
+
+    def __len__(self):
+        return self.size
@@ -1,43 +1,469 @@
 import cv2
 import os
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image
 import imagehash
+from preprocess.phash import downscale, phash_batch, hamming
+from preprocess.keyframe_index import BKTree
+from preprocess.storage import atomic_write_bytes
+from preprocess.change_detect import MIN_CHANGED_FRACTION, TiledChangeDetector, tile_signature
+
+# Seconds between hashed frames outside the post-keyframe window. Sampling every frame costs
+# several times more on long videos and, on screen recordings, finds the same keyframes
+DEFAULT_SAMPLE_INTERVAL = 0.5
+# Skips shorter than this many frames are walked with grab(); longer ones are seeked
+SEEK_MIN_GAP = 30
+# Thumbnails hashed per phash_batch() call by parallel workers that hash every grid frame (tiled
+# detector); workers that skip keyframe windows need each hash at once and hash frames one by one
+HASH_BATCH = 256
+# Segments per worker in the parallel mode; smaller segments let keyframes stream out sooner
+SEGMENTS_PER_WORKER = 4
+# A keyframe budget may be spent in bursts of up to this many seconds' worth
+BUDGET_BURST_SECONDS = 10
+# Adaptive sampling: interval bounds (seconds), minimum keyframe spacing and default budget
+ADAPTIVE_MIN_INTERVAL = 0.25
+ADAPTIVE_MAX_INTERVAL = 4.0
+ADAPTIVE_MIN_GAP = 1.0
+ADAPTIVE_KEYFRAMES_PER_MINUTE = 12
+# Mean absolute difference (0-1) between consecutive 32x32 thumbnails that counts as a burst / as idle
+ACTIVITY_BURST = 0.01
+ACTIVITY_IDLE = 0.001
 
 def format_timestamp(seconds):
     m = int(seconds // 60)
     s = int(seconds % 60)
     return f"[{m:02d}:{s:02d}]"
 
-def extract_keyframes(video_path, output_dir="output/keyframes", phash_thresh=8, max_per_5s=1):
+def _read_at(cap, pos, target, video_path, use_seek):
+    """
+    Decode frame `target` from `cap`, whose next frame is `pos`, without converting the frames in between.
+    Returns (cap, frame, use_seek); frame is None past the end of the video.
+    Seeking is verified against the decoded frame's timestamp; the first time it lands on the wrong
+    frame (codecs/containers with poor seek support) the capture is reopened and walked with grab() instead.
+    """
+    if use_seek and target - pos >= SEEK_MIN_GAP:
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        if cap.set(cv2.CAP_PROP_POS_FRAMES, target):
+            ret, frame = cap.read()
+            if ret and abs(cap.get(cv2.CAP_PROP_POS_MSEC) - target * 1000 / fps) < 500 / fps:
+                return cap, frame, True
+        print(f"[WARN] Inaccurate seek in {video_path}, falling back to sequential grab()")
+        cap.release()
+        cap = cv2.VideoCapture(video_path)
+        pos = 0
+        use_seek = False
+    for _ in range(target - pos):
+        if not cap.grab():
+            return cap, None, use_seek
+    ret, frame = cap.read()
+    return cap, (frame if ret else None), use_seek
+
+def _next_candidate(frame_id, step, fps, selector):
+    """Index of the next sampling-grid frame at which the selector can accept a keyframe again."""
+    nxt = frame_id + step
+    if not selector.due(nxt / fps):
+        nxt = max(nxt, int(selector.next_due() * fps))
+        while not selector.due(nxt / fps):
+            nxt += 1
+        nxt += -nxt % step
+    return nxt
+
+def _phash(frame, hash_method="dct"):
+    """64-bit perceptual hash of a BGR frame as an int."""
+    if hash_method == "imagehash":
+        return int(str(imagehash.phash(Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)))), 16)
+    return int(phash_batch(downscale(frame))[0])
+
+class _KeyframeSelector:
+    """
+    Keyframe acceptance rule, shared by the serial loop and the merge pass of the parallel mode.
+
+    With `dedupe="previous"` a frame is kept if it differs from the last keyframe. With
+    `dedupe="global"` it must also differ from every earlier keyframe (looked up in a BK-tree);
+    a frame matching an earlier keyframe is dropped, or, with `revisits=True`, recorded as a
+    revisit of that keyframe so its analysis can be reused.
+
+    Keyframes are at least `min_gap` seconds apart. With `keyframes_per_minute`, new keyframes
+    (each one a vision call downstream) also draw from a token bucket refilled at that rate, which
+    allows short bursts of up to BUDGET_BURST_SECONDS worth of budget.
+
+    With a `detector` (TiledChangeDetector), "differs from the last keyframe" is decided from
+    per-tile signatures instead of the global pHash distance, so cursor and clock noise is ignored;
+    global dedupe still uses the pHash index.
+    """
+
+    def __init__(self, phash_thresh, min_gap=5, dedupe="previous", revisits=False, keyframes_per_minute=None, detector=None):
+        if dedupe not in ("previous", "global"):
+            raise ValueError(f"Unknown dedupe mode: {dedupe}")
+        self.phash_thresh = phash_thresh
+        self.min_gap = min_gap
+        self.dedupe = dedupe
+        self.revisits = revisits
+        self.index = BKTree()
+        self.count = 0
+        self.prev_hash = None
+        self.detector = detector
+        self.prev_signature = None
+        self.last_saved_sec = -min_gap
+        # pHash bits that changed between the last two keyframes (None for the first)
+        self.last_change = None
+        self.rate = keyframes_per_minute / 60 if keyframes_per_minute else None
+        if self.rate:
+            self.capacity = max(1.0, self.rate * BUDGET_BURST_SECONDS)
+            self.tokens = self.capacity
+            self.tokens_sec = 0.0
+
+    def _tokens_at(self, sec):
+        return min(self.capacity, self.tokens + (sec - self.tokens_sec) * self.rate)
+
+    def due(self, sec):
+        # The budget is checked in offer(): revisits don't spend it, so they are taken even when it is empty
+        return sec - self.last_saved_sec >= self.min_gap
+
+    def next_due(self):
+        """Earliest time (seconds) at which `due` can be true again."""
+        return self.last_saved_sec + self.min_gap
+
+    def observe(self, sec, signature):
+        """Feed every sample in order (due or not) so the detector can learn its static mask."""
+        if self.detector is not None:
+            self.detector.observe(sec, signature)
+
+    @property
+    def learning(self):
+        return self.detector is not None and self.detector.learning
+
+    def offer(self, sec, curr_hash, signature=None):
+        """
+        Decide on a frame. Returns (accepted, revisit_of): revisit_of is the index of the earlier
+        keyframe this frame returns to, or None for a new keyframe.
+        """
+        if self.detector is not None:
+            if self.prev_signature is not None and not self.detector.changed(self.prev_signature, signature):
+                return False, None
+        elif self.prev_hash is not None and hamming(curr_hash, self.prev_hash) <= self.phash_thresh:
+            return False, None
+        revisit_of = None
+        if self.dedupe == "global":
+            match = self.index.nearest(curr_hash, self.phash_thresh)
+            if match is not None:
+                if not self.revisits:
+                    return False, None
+                revisit_of = match[1]
+        if revisit_of is None:
+            if self.rate and self._tokens_at(sec) < 1:
+                return False, None
+            self.index.add(curr_hash, self.count)
+            if self.rate:
+                self.tokens = self._tokens_at(sec) - 1
+                self.tokens_sec = sec
+        self.count += 1
+        self.last_change = hamming(curr_hash, self.prev_hash) if self.prev_hash is not None else None
+        self.prev_hash = curr_hash
+        self.prev_signature = signature
+        self.last_saved_sec = sec
+        return True, revisit_of
+
+class _AdaptiveSampler:
+    """
+    Chooses the sampling step from visual activity: the mean absolute difference between the
+    32x32 thumbnails of consecutive samples. A burst drops the interval to ADAPTIVE_MIN_INTERVAL;
+    each idle sample doubles it, up to ADAPTIVE_MAX_INTERVAL.
+    """
+
+    def __init__(self, fps, start_interval=1.0):
+        self.min_step = max(1, int(round(ADAPTIVE_MIN_INTERVAL * fps)))
+        self.max_step = max(self.min_step, int(round(ADAPTIVE_MAX_INTERVAL * fps)))
+        self.step = min(max(int(round(start_interval * fps)), self.min_step), self.max_step)
+        self.prev_thumb = None
+
+    def update(self, thumb):
+        if self.prev_thumb is not None:
+            activity = float(cv2.absdiff(thumb, self.prev_thumb).mean()) / 255
+            if activity > ACTIVITY_BURST:
+                self.step = self.min_step
+            elif activity < ACTIVITY_IDLE:
+                self.step = min(self.step * 2, self.max_step)
+        self.prev_thumb = thumb
+        return self.step
+
+def encode_analysis_jpeg(frame, width=512, quality=85):
+    """Downscale a BGR frame to `width` px (keeping aspect ratio) and JPEG-encode it for vision calls."""
+    h, w = frame.shape[:2]
+    if w > width:
+        frame = cv2.resize(frame, (width, int(h * width / w)), interpolation=cv2.INTER_AREA)
+    ok, buf = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise ValueError("Could not JPEG-encode frame")
+    return buf.tobytes()
+
+class _KeyframeWriter:
+    """
+    Turns accepted frames into keyframe entries. The full-resolution JPEG (used by the decks) is
+    written atomically (temp file + rename) only if `save_full_res`; with `analysis_width` the entry also carries the downscaled
+    analysis JPEG as "image" bytes, so summarize_keyframe never has to re-read the file.
+    """
+
+    def __init__(self, output_dir, fps, save_full_res=True, analysis_width=None):
+        self.output_dir = output_dir
+        self.fps = fps
+        self.save_full_res = save_full_res
+        self.analysis_width = analysis_width
+
+    def write(self, frame, frame_id, change=None, jpeg=None):
+        """`jpeg` is the frame already encoded (e.g. by ffmpeg), written as is instead of re-encoding."""
+        filename = None
+        if self.save_full_res:
+            filename = f"{self.output_dir}/frame_{frame_id}.jpg"
+            if jpeg is None:
+                ok, buf = cv2.imencode(".jpg", frame)
+                if not ok:
+                    raise ValueError(f"Could not JPEG-encode frame {frame_id}")
+                jpeg = buf.tobytes()
+            atomic_write_bytes(filename, jpeg)
+        keyframe = {
+            "path": filename,
+            "timestamp": format_timestamp(frame_id / self.fps),
+            "change": change
+        }
+        if self.analysis_width:
+            keyframe["image"] = encode_analysis_jpeg(frame, self.analysis_width)
+        return keyframe
+
+    def revisit(self, keyframes, revisit_of, frame_id, change=None):
+        return {
+            "path": keyframes[revisit_of]["path"],
+            "timestamp": format_timestamp(frame_id / self.fps),
+            "change": change,
+            "revisit_of": revisit_of
+        }
+
+def _hash_segment(args):
+    """
+    Worker: pHash the sampling-grid frames in [start, end) that the serial loop would likely visit.
+    With `skip_frames`, the window after each frame that differs from the segment's previous such
+    frame is skipped, as the serial loop skips the window after a keyframe; otherwise every grid
+    frame is hashed. Returns {frame_id: (hash, tile_signature or None)}.
+    """
+    video_path, start, end, step, hash_method, tile_grid, phash_thresh, skip_frames = args
+    cap = cv2.VideoCapture(video_path)
+    cap, frame, use_seek = _read_at(cap, 0, start, video_path, True)
+    frame_ids, hashes, thumbs, signatures = [], [], [], []
+    prev_hash = None
+    frame_id = start
+    while frame is not None:
+        frame_ids.append(frame_id)
+        signatures.append(tile_signature(frame, tile_grid) if tile_grid else None)
+        nxt = frame_id + step
+        if skip_frames:
+            curr_hash = _phash(frame, hash_method)
+            hashes.append(curr_hash)
+            if prev_hash is None or hamming(curr_hash, prev_hash) > phash_thresh:
+                prev_hash = curr_hash
+                nxt = frame_id + skip_frames
+                nxt += -nxt % step
+        elif hash_method == "dct":
+            # Keep only the 32x32 thumbnail and hash in batches
+            thumbs.append(downscale(frame))
+            if len(thumbs) == HASH_BATCH:
+                hashes.extend(int(h) for h in phash_batch(thumbs))
+                thumbs = []
+        else:
+            hashes.append(_phash(frame, hash_method))
+        if nxt >= end:
+            break
+        cap, frame, use_seek = _read_at(cap, frame_id + 1, nxt, video_path, use_seek)
+        frame_id = nxt
+    cap.release()
+    if thumbs:
+        hashes.extend(int(h) for h in phash_batch(thumbs))
+    return dict(zip(frame_ids, zip(hashes, signatures)))
+
+def _iter_keyframes_parallel(video_path, writer, selector, fps, frame_count, step, workers, hash_method):
+    """
+    Split the video into time segments, hash each segment in a pool process, then run the serial
+    loop over the merged samples: the frames it visits are looked up in the workers' results, and
+    the few a worker skipped (its window guess differed, e.g. at a segment start) are decoded and
+    hashed here. The result is the same as the serial output.
+
+    Segments are replayed in order as soon as each one is hashed, and only accepted frames are
+    decoded again (in this process) to be written out, so keyframes are yielded while later
+    segments are still being processed.
+    """
+    seg_len = -(-frame_count // (workers * SEGMENTS_PER_WORKER))
+    seg_len += -seg_len % step
+    tile_grid = selector.detector.grid if selector.detector else None
+    # The tiled detector's decisions depend on its learned mask, so workers can't guess its windows
+    skip_frames = None if tile_grid else max(step, int(selector.min_gap * fps))
+    segments = [(video_path, start, min(start + seg_len, frame_count), step, hash_method, tile_grid,
+                 selector.phash_thresh, skip_frames)
+                for start in range(0, frame_count, seg_len)]
+    keyframes = []
+    cap = cv2.VideoCapture(video_path)
+    pos, use_seek = 0, True
+    frame_id = 0
+    try:
+        # spawn, not fork: this runs next to the API's torch and asyncio threads
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            for (_, _, end, *_), samples in zip(segments, pool.map(_hash_segment, segments)):
+                while frame_id < end:
+                    sec = frame_id / fps
+                    frame = None
+                    if frame_id in samples:
+                        curr_hash, signature = samples[frame_id]
+                    else:
+                        cap, frame, use_seek = _read_at(cap, pos, frame_id, video_path, use_seek)
+                        if frame is None:
+                            return
+                        pos = frame_id + 1
+                        curr_hash = _phash(frame, hash_method)
+                        signature = tile_signature(frame, tile_grid) if tile_grid else None
+                    selector.observe(sec, signature)
+                    ok, revisit_of = selector.offer(sec, curr_hash, signature) if selector.due(sec) else (False, None)
+                    if ok:
+                        if revisit_of is not None:
+                            keyframe = writer.revisit(keyframes, revisit_of, frame_id, selector.last_change)
+                        else:
+                            if frame is None:
+                                cap, frame, use_seek = _read_at(cap, pos, frame_id, video_path, use_seek)
+                                if frame is None:
+                                    return
+                                pos = frame_id + 1
+                            keyframe = writer.write(frame, frame_id, selector.last_change)
+                        keyframes.append(keyframe)
+                        yield keyframe
+                    frame_id = frame_id + step if selector.learning else _next_candidate(frame_id, step, fps, selector)
+    finally:
+        cap.release()
+
+def iter_keyframes(video_path, output_dir="output/keyframes", phash_thresh=8, max_per_5s=1, sample_interval=DEFAULT_SAMPLE_INTERVAL, seek=True, workers=1, backend="opencv", scene_thresh=0.3, hash_method="dct", dedupe="previous", revisits=False, save_full_res=True, analysis_width=None, adaptive=False, keyframes_per_minute=None, change_detector="phash", min_changed_fraction=MIN_CHANGED_FRACTION, mask_learn_seconds=0, scratch_dir=None):
+    """
+    Extract visually distinct keyframes from a video, yielding each one as soon as it is accepted.
+
+    Keyframes are at least 5 / `max_per_5s` s apart (optionally capped at `keyframes_per_minute`),
+    with one frame hashed every `sample_interval` s in between (None = every frame). See the
+    module constants and helpers for `adaptive`, `workers`, `change_detector`, `dedupe`/`revisits`
+    and `backend`.
+
+    Entries are {"path", "timestamp", "change"} ("change": pHash bits changed since the previous keyframe).
+    """
+    if backend not in ("opencv", "ffmpeg"):
+        raise ValueError(f"Unknown keyframe backend: {backend}")
+    if backend == "ffmpeg" and (adaptive or change_detector != "phash"):
+        raise ValueError("The ffmpeg backend supports neither adaptive sampling nor the tiled change detector")
     os.makedirs(output_dir, exist_ok=True)
     cap = cv2.VideoCapture(video_path)
     fps = cap.get(cv2.CAP_PROP_FPS)
-    prev_hash = None
+    if not cap.isOpened() or not fps:
+        cap.release()
+        return
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    step = max(1, int(round(sample_interval * fps))) if sample_interval else 1
+    min_gap = 5 / max_per_5s
+    sampler = None
+    if adaptive:
+        if workers and workers > 1:
+            cap.release()
+            raise ValueError("Adaptive sampling cannot be combined with workers > 1")
+        sampler = _AdaptiveSampler(fps, start_interval=sample_interval or 1.0)
+        step = sampler.step
+        min_gap = min(min_gap, ADAPTIVE_MIN_GAP)
+        keyframes_per_minute = keyframes_per_minute or ADAPTIVE_KEYFRAMES_PER_MINUTE
+    detector = None
+    if change_detector == "tiles":
+        detector = TiledChangeDetector(min_changed_fraction=min_changed_fraction, learn_seconds=mask_learn_seconds)
+    elif change_detector != "phash":
+        cap.release()
+        raise ValueError(f"Unknown change detector: {change_detector}")
+    selector = _KeyframeSelector(phash_thresh, min_gap=min_gap, dedupe=dedupe, revisits=revisits,
+                                 keyframes_per_minute=keyframes_per_minute, detector=detector)
+    writer = _KeyframeWriter(output_dir, fps, save_full_res=save_full_res, analysis_width=analysis_width)
+    if backend == "ffmpeg":
+        cap.release()
+        from preprocess.scene_detect import extract_scene_keyframes
+        yield from extract_scene_keyframes(video_path, selector, writer, fps, scene_thresh=scene_thresh,
+                                           hash_method=hash_method, threads=workers, scratch_dir=scratch_dir)
+        return
+    if workers and workers > 1 and frame_count > 0:
+        cap.release()
+        yield from _iter_keyframes_parallel(video_path, writer, selector, fps, frame_count, step, workers, hash_method)
+        return
+
     frame_id = 0
-    saved = 0
-    last_saved_sec = -5
+    pos = 0
     keyframes = []
+    try:
+        while frame_count <= 0 or frame_id < frame_count:
+            cap, frame, seek = _read_at(cap, pos, frame_id, video_path, seek)
+            if frame is None:
+                break
+            pos = frame_id + 1
+            sec = frame_id / fps
+            thumb = downscale(frame)
+            if sampler:
+                step = sampler.update(thumb)
+            curr_hash = int(phash_batch(thumb)[0]) if hash_method == "dct" else _phash(frame, hash_method)
+            signature = tile_signature(frame, detector.grid) if detector else None
+            selector.observe(sec, signature)
+            ok, revisit_of = selector.offer(sec, curr_hash, signature) if selector.due(sec) else (False, None)
+            if ok:
+                if revisit_of is not None:
+                    keyframe = writer.revisit(keyframes, revisit_of, frame_id, selector.last_change)
+                else:
+                    keyframe = writer.write(frame, frame_id, selector.last_change)
+                keyframes.append(keyframe)
+                yield keyframe
+            # While the static mask is being learned every grid frame is observed, window or not
+            frame_id = frame_id + step if selector.learning else _next_candidate(frame_id, step, fps, selector)
+    finally:
+        cap.release()
 
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if not ret:
-            break
-        sec = frame_id / fps
-        if sec - last_saved_sec < 5:
-            frame_id += 1
-            continue
-        pil_img = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
-        curr_hash = imagehash.phash(pil_img)
-        if prev_hash is None or (curr_hash - prev_hash) > phash_thresh:
-            filename = f"{output_dir}/frame_{frame_id}.jpg"
-            cv2.imwrite(filename, frame)
-            keyframes.append({
-                "path": filename,
-                "timestamp": format_timestamp(sec)
-            })
-            saved += 1
-            last_saved_sec = sec
-            prev_hash = curr_hash
-        frame_id += 1
-    cap.release()
-    return keyframes
+def extract_keyframes(video_path, *args, **kwargs):
+    """Extract keyframes as a list; takes the same arguments as `iter_keyframes`."""
+    return list(iter_keyframes(video_path, *args, **kwargs))
+
+def stream_keyframes(video_path, max_buffer=16, **kwargs):
+    """
+    Run `iter_keyframes` in a background thread and yield keyframes as they are accepted, so the
+    caller can analyze early keyframes (network-bound LLM calls) while later parts of the video are
+    still being decoded. At most `max_buffer` keyframes are queued ahead of the consumer; errors
+    raised during extraction are re-raised in the consumer.
+    """
+    q = queue.Queue(maxsize=max_buffer)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for keyframe in iter_keyframes(video_path, **kwargs):
+                if not put((keyframe, None)):
+                    return
+            put((done, None))
+        except Exception as e:
+            put((None, e))
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            item, error = q.get()
+            if error is not None:
+                raise error
+            if item is done:
+                break
+            yield item
+    finally:
+        stop.set()
+        producer.join()
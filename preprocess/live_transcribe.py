@@ -0,0 +1,78 @@
+import threading
+from preprocess.extract_audio import SAMPLE_RATE, extract_audio_pcm
+from preprocess.transcribe import submit_transcription
+from preprocess.transcript import Transcript
+from preprocess.vad import is_silent
+
+class IncrementalTranscriber:
+    """
+    Keeps a rolling transcript of a recording that is still being uploaded.
+
+    A background thread wakes up every `interval` seconds, decodes the audio received after the
+    committed point and transcribes it in the Whisper worker pool (see submit_transcription).
+    Segments ending more than `holdback` seconds before the end of the received audio are committed
+    (the last words may still be cut off mid-upload); the rest is transcribed again on the next
+    pass. When the upload finishes, `finish()` only has to transcribe the uncommitted tail.
+    """
+
+    def __init__(self, media_path, interval=10.0, holdback=5.0, model_name=None, workers=None):
+        self.media_path = media_path
+        self.interval = interval
+        self.holdback = holdback
+        self.model_name = model_name
+        # Same worker count as the /process jobs, so both use the same (already warm) pool
+        self.workers = workers
+        self.segments = Transcript()
+        self.committed_sec = 0.0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self._step(final=False)
+            except Exception as e:
+                print(f"[WARN] Incremental transcription of {self.media_path} failed: {e}")
+
+    def _step(self, final):
+        start = self.committed_sec
+        # Only the audio after the committed point is decoded, so each pass costs the same
+        tail = extract_audio_pcm(self.media_path, allow_truncated=not final, start=start)
+        received_sec = start + len(tail) / SAMPLE_RATE
+        cutoff = received_sec if final else received_sec - self.holdback
+        if cutoff <= start:
+            return
+        if is_silent(tail):
+            # Nothing audible at all since the last commit
+            self.committed_sec = cutoff
+            return
+        segments = submit_transcription(tail, self.model_name, self.workers).result()
+        committed = Transcript()
+        for seg_start, seg_end, text in zip(segments.starts, segments.ends, segments.texts):
+            if final or start + seg_end <= cutoff:
+                committed.append(start + seg_start, start + seg_end, text)
+        with self._lock:
+            self.segments.extend(committed)
+            if committed:
+                self.committed_sec = received_sec if final else committed.ends[-1]
+
+    def transcript(self):
+        """The transcript committed so far, as a Transcript like transcribe_audio's."""
+        with self._lock:
+            return self.segments.copy()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive() and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def finish(self):
+        """Stop the background worker, transcribe the remaining tail and return the full transcript."""
+        self.stop()
+        self._step(final=True)
+        return self.transcript()
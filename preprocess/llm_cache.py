@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from preprocess.llm_scheduler import schedule, schedule_async
+
+# SQLite file holding cached chat completions; LLM_CACHE=0 turns caching off
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE", "1") != "0"
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", os.path.join("cache", "llm_cache.sqlite"))
+# Entries expire after LLM_CACHE_TTL_DAYS; beyond LLM_CACHE_MAX_MB the least recently used are dropped
+LLM_CACHE_TTL_DAYS = float(os.getenv("LLM_CACHE_TTL_DAYS", 30))
+LLM_CACHE_MAX_MB = float(os.getenv("LLM_CACHE_MAX_MB", 256))
+
+_CONN = None
+_CLIENT = None
+_LOCK = threading.Lock()
+_STATS = {"hits": 0, "misses": 0, "expired": 0, "evicted": 0}
+
+def _connect():
+    global _CONN
+    if _CONN is None:
+        os.makedirs(os.path.dirname(LLM_CACHE_PATH) or ".", exist_ok=True)
+        _CONN = sqlite3.connect(LLM_CACHE_PATH, check_same_thread=False, timeout=30)
+        _CONN.execute("PRAGMA journal_mode=WAL")
+        _CONN.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, model TEXT, response TEXT, size INTEGER, created REAL, accessed REAL)"
+        )
+        _CONN.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        _CONN.commit()
+    return _CONN
+
+def _client():
+    """
+    Sync client shared by chat_completion. Retries are disabled: the scheduler is the only retry
+    layer, since SDK retries would happen outside its RPM/TPM budgets and never trigger its backoff.
+    Created on first use, so importing this module doesn't require OPENAI_API_KEY.
+    """
+    global _CLIENT
+    with _LOCK:
+        if _CLIENT is None:
+            import openai
+            _CLIENT = openai.OpenAI(max_retries=0)
+        return _CLIENT
+
+def _normalize(value):
+    """Replace inline base64 images with their SHA-256 so keys stay small and stable."""
+    if isinstance(value, dict):
+        return {k: _normalize(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    if isinstance(value, str) and value.startswith("data:") and ";base64," in value:
+        return "sha256:" + hashlib.sha256(value.encode("ascii", "ignore")).hexdigest()
+    return value
+
+def request_key(**params):
+    """Cache key of a chat completion request: model, messages and every other parameter."""
+    payload = json.dumps(_normalize(params), sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def _get(key):
+    now = time.time()
+    with _LOCK:
+        conn = _connect()
+        row = conn.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            _STATS["misses"] += 1
+            return None
+        if now - row[1] > LLM_CACHE_TTL_DAYS * 86400:
+            conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            conn.commit()
+            _STATS["expired"] += 1
+            _STATS["misses"] += 1
+            return None
+        conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        conn.commit()
+        _STATS["hits"] += 1
+    from openai.types.chat import ChatCompletion
+    return ChatCompletion.model_validate_json(row[0])
+
+def _put(key, model, response):
+    data = response.model_dump_json()
+    now = time.time()
+    with _LOCK:
+        conn = _connect()
+        conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                     (key, model, data, len(data), now, now))
+        _evict(conn)
+        conn.commit()
+
+def _evict(conn):
+    max_bytes = LLM_CACHE_MAX_MB * 2**20
+    total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+    if total <= max_bytes:
+        return
+    for key, size in conn.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall():
+        if total <= max_bytes:
+            break
+        conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+        total -= size
+        _STATS["evicted"] += 1
+
+def _cacheable(params):
+    return LLM_CACHE_ENABLED and not params.get("stream")
+
+def _storable(response, validate):
+    """Only completions with content that passes `validate` are cached, so a retry gets a fresh answer."""
+    try:
+        content = response.choices[0].message.content
+    except (AttributeError, IndexError):
+        return False
+    if not content or not content.strip():
+        return False
+    return validate is None or bool(validate(response))
+
+def chat_completion(validate=None, **params):
+    """
+    Drop-in for `openai.chat.completions.create(**params)` that answers repeated requests from the
+    SQLite cache. Identical model, messages and parameters (images compared by hash) return the
+    stored completion without an API call; everything else goes through the rate-limit scheduler
+    (preprocess.llm_scheduler).
+
+    Empty completions, and ones for which `validate(response)` is falsy, are returned but not
+    cached, so retrying the same request calls the API again.
+    """
+    client = _client()
+    call = lambda: client.chat.completions.create(**params)
+    if not _cacheable(params):
+        return schedule(call, params)
+    key = request_key(**params)
+    cached = _get(key)
+    if cached is not None:
+        return cached
+    response = schedule(call, params)
+    if _storable(response, validate):
+        _put(key, params.get("model"), response)
+    return response
+
+async def chat_completion_async(client, validate=None, **params):
+    """chat_completion for an `openai.AsyncOpenAI` client."""
+    client = client.with_options(max_retries=0)
+    call = lambda: client.chat.completions.create(**params)
+    if not _cacheable(params):
+        return await schedule_async(call, params)
+    key = request_key(**params)
+    cached = _get(key)
+    if cached is not None:
+        return cached
+    response = await schedule_async(call, params)
+    if _storable(response, validate):
+        _put(key, params.get("model"), response)
+    return response
+
+def cache_stats():
+    """Hit/miss counters for this process plus the size of the cache."""
+    with _LOCK:
+        stats = dict(_STATS)
+        if LLM_CACHE_ENABLED:
+            entries, size = _connect().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+            stats.update(entries=entries, size_mb=round(size / 2**20, 2))
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else None
+    return stats
@@ -0,0 +1,234 @@
+import os
+import time
+import heapq
+import random
+import asyncio
+import itertools
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Per-model (requests per minute, tokens per minute). Override or extend with
+# OPENAI_RATE_LIMITS="gpt-4o=500/30000,gpt-4o-mini=500/200000"
+RATE_LIMITS = {
+    "gpt-4o": (500, 30000),
+    "gpt-4o-mini": (500, 200000),
+}
+DEFAULT_RATE_LIMIT = (int(os.getenv("OPENAI_DEFAULT_RPM", 500)), int(os.getenv("OPENAI_DEFAULT_TPM", 30000)))
+for _spec in filter(None, os.getenv("OPENAI_RATE_LIMITS", "").split(",")):
+    _model, _limits = _spec.split("=")
+    _rpm, _tpm = _limits.split("/")
+    RATE_LIMITS[_model.strip()] = (int(_rpm), int(_tpm))
+
+# Retries after 429s, timeouts, connection errors and 5xx: full-jitter exponential backoff
+MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", 6))
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 60.0
+# Rough prompt cost of one (<=512px, single tile) image input
+IMAGE_TOKENS = 255
+
+# Lower values are served first. Interactive calls default to 0; process_video runs its calls
+# under its start time, so earlier jobs finish first instead of all jobs slowing down together
+_PRIORITY = contextvars.ContextVar("llm_priority", default=0.0)
+_SEQ = itertools.count()
+_LIMITERS = {}
+_LIMITERS_LOCK = threading.Lock()
+
+@contextmanager
+def llm_priority(priority):
+    """Run the LLM calls made in this block (and in asyncio tasks started from it) at `priority`."""
+    token = _PRIORITY.set(priority)
+    try:
+        yield
+    finally:
+        _PRIORITY.reset(token)
+
+def with_current_priority(fn):
+    """Wrap `fn` to run at the caller's priority, e.g. when handing LLM calls to a thread pool."""
+    priority = _PRIORITY.get()
+    def run(*args, **kwargs):
+        with llm_priority(priority):
+            return fn(*args, **kwargs)
+    return run
+
+class _ModelLimiter:
+    """
+    Request and token buckets for one model, each refilled continuously at its per-minute limit,
+    plus a priority queue: only the head of the queue may take capacity, so calls are admitted
+    strictly by (priority, arrival) across all jobs in the process.
+    """
+
+    def __init__(self, rpm, tpm):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = float(rpm)
+        self.tokens = float(tpm)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.queue = []
+        self.cond = threading.Condition()
+        self.stats = {"requests": 0, "retries": 0, "rate_limited": 0, "wait_total": 0.0, "wait_max": 0.0}
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        self.updated = now
+        self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+
+    def acquire(self, tokens, priority):
+        # A request larger than the whole minute budget would otherwise wait forever
+        tokens = min(tokens, self.tpm)
+        entry = (priority, next(_SEQ))
+        start = time.monotonic()
+        with self.cond:
+            heapq.heappush(self.queue, entry)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if self.queue[0] != entry:
+                        self.cond.wait(1.0)
+                        continue
+                    wait = max(self.paused_until - now,
+                               (1 - self.requests) * 60 / self.rpm,
+                               (tokens - self.tokens) * 60 / self.tpm)
+                    if wait <= 0:
+                        break
+                    self.cond.wait(wait)
+            except BaseException:
+                self.queue.remove(entry)
+                heapq.heapify(self.queue)
+                self.cond.notify_all()
+                raise
+            heapq.heappop(self.queue)
+            self.requests -= 1
+            self.tokens -= tokens
+            waited = time.monotonic() - start
+            self.stats["requests"] += 1
+            self.stats["wait_total"] += waited
+            self.stats["wait_max"] = max(self.stats["wait_max"], waited)
+            self.cond.notify_all()
+        return tokens
+
+    def settle(self, reserved, used):
+        """Return the part of the reservation the request didn't use (or charge the overrun)."""
+        with self.cond:
+            self.tokens = min(self.tpm, self.tokens + reserved - used)
+            self.cond.notify_all()
+
+    def pause(self, seconds):
+        """Stop admitting requests for `seconds` after the API reported a rate limit."""
+        with self.cond:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.stats["rate_limited"] += 1
+
+def _limiter(model):
+    with _LIMITERS_LOCK:
+        limiter = _LIMITERS.get(model)
+        if limiter is None:
+            limiter = _LIMITERS[model] = _ModelLimiter(*RATE_LIMITS.get(model, DEFAULT_RATE_LIMIT))
+        return limiter
+
+def estimate_tokens(params):
+    """Upper-bound token cost the rate limiter charges for a request: prompt estimate plus max_tokens."""
+    n = 0
+    for message in params.get("messages", []):
+        content = message.get("content") or ""
+        parts = content if isinstance(content, list) else [{"type": "text", "text": content}]
+        for part in parts:
+            if part.get("type") == "image_url":
+                n += IMAGE_TOKENS
+            else:
+                n += len(part.get("text", "")) // 4 + 1
+        n += 4
+    return n + (params.get("max_tokens") or 1000)
+
+def _retry_delay(error, attempt):
+    """Seconds to wait before retrying `error`, or None if it isn't worth retrying."""
+    import openai
+    if isinstance(error, openai.RateLimitError):
+        if getattr(error, "code", None) == "insufficient_quota":
+            return None
+    elif not isinstance(error, (openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)):
+        return None
+    if attempt >= MAX_RETRIES:
+        return None
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(retry_after)
+    except (TypeError, ValueError):
+        return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+def _after_error(limiter, error, attempt):
+    import openai
+    delay = _retry_delay(error, attempt)
+    if delay is None:
+        return None
+    limiter.stats["retries"] += 1
+    print(f"[WARN] OpenAI request failed ({type(error).__name__}), retrying in {delay:.1f}s")
+    if isinstance(error, openai.RateLimitError):
+        # Every queued call for this model backs off, not just this one
+        limiter.pause(delay)
+        return 0.0
+    return delay
+
+def _settle(limiter, reserved, response):
+    usage = getattr(response, "usage", None)
+    if usage is not None and getattr(usage, "total_tokens", None) is not None:
+        limiter.settle(reserved, usage.total_tokens)
+
+def schedule(call, params):
+    """
+    Run `call()` (an OpenAI request built from `params`) once the model's RPM/TPM budget allows,
+    in priority order, retrying transient failures with jittered exponential backoff.
+    """
+    limiter = _limiter(params.get("model"))
+    estimate = estimate_tokens(params)
+    priority = _PRIORITY.get()
+    for attempt in itertools.count():
+        reserved = limiter.acquire(estimate, priority)
+        try:
+            response = call()
+        except Exception as e:
+            delay = _after_error(limiter, e, attempt)
+            if delay is None:
+                raise
+            time.sleep(delay)
+            continue
+        _settle(limiter, reserved, response)
+        return response
+
+async def schedule_async(call, params):
+    """schedule for coroutine-returning `call`s; waiting for capacity happens off the event loop."""
+    limiter = _limiter(params.get("model"))
+    estimate = estimate_tokens(params)
+    priority = _PRIORITY.get()
+    for attempt in itertools.count():
+        reserved = await asyncio.to_thread(limiter.acquire, estimate, priority)
+        try:
+            response = await call()
+        except Exception as e:
+            delay = _after_error(limiter, e, attempt)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+            continue
+        _settle(limiter, reserved, response)
+        return response
+
+def scheduler_stats():
+    """Per-model queue depth, admitted requests, retries, 429s and time spent waiting for capacity."""
+    stats = {}
+    with _LIMITERS_LOCK:
+        limiters = dict(_LIMITERS)
+    for model, limiter in limiters.items():
+        with limiter.cond:
+            s = dict(limiter.stats)
+            s["queue_depth"] = len(limiter.queue)
+            s["wait_avg"] = round(s["wait_total"] / s["requests"], 3) if s["requests"] else 0.0
+            s["wait_total"] = round(s["wait_total"], 3)
+            s["wait_max"] = round(s["wait_max"], 3)
+            s["limits"] = {"rpm": limiter.rpm, "tpm": limiter.tpm}
+        stats[model] = s
+    return stats
@@ -0,0 +1,37 @@
+import cv2
+import numpy as np
+
+# Same geometry as imagehash.phash: 8x8 low-frequency block of the DCT of a 32x32 grayscale image
+HASH_SIZE = 8
+IMG_SIZE = HASH_SIZE * 4
+
+def _dct_rows(n, rows):
+    """First `rows` rows of the (unnormalized) DCT-II matrix for length-n signals."""
+    k = np.arange(rows)[:, None]
+    i = np.arange(n)[None, :]
+    return np.cos(np.pi * k * (2 * i + 1) / (2 * n))
+
+_DCT = _dct_rows(IMG_SIZE, HASH_SIZE).astype(np.float32)
+
+def downscale(frame):
+    """Shrink a BGR (or grayscale) frame to the 32x32 grayscale thumbnail the hash is computed from."""
+    small = cv2.resize(frame, (IMG_SIZE, IMG_SIZE), interpolation=cv2.INTER_AREA)
+    if small.ndim == 3:
+        small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    return small
+
+def phash_batch(thumbs):
+    """
+    Perceptual hashes for a batch of 32x32 thumbnails, as a uint64 array.
+
+    Computes the low-frequency 8x8 DCT block of every thumbnail with two matrix products and
+    sets the bits above each block's median, like imagehash.phash, so Hamming distances can be
+    compared against the same `phash_thresh` values.
+    """
+    x = np.asarray(thumbs, dtype=np.float32).reshape(-1, IMG_SIZE, IMG_SIZE)
+    low = (_DCT @ x @ _DCT.T).reshape(len(x), -1)
+    bits = low > np.median(low, axis=1, keepdims=True)
+    return np.packbits(bits, axis=1).view(">u8").ravel()
+
+def hamming(a, b):
+    return bin(int(a) ^ int(b)).count("1")
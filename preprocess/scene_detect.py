@@ -0,0 +1,59 @@
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import cv2
+import numpy as np
+from preprocess.keyframes import _phash
+
+# showinfo logs one line per frame that passed the select filter
+SHOWINFO_RE = re.compile(r"Parsed_showinfo.*?pts_time:\s*([0-9.]+)")
+
+def extract_scene_keyframes(video_path, selector, writer, fps, scene_thresh=0.3, hash_method="dct", threads=None, scratch_dir=None):
+    """
+    ffmpeg backend for keyframe extraction.
+
+    A single ffmpeg pass runs the scene-change filter (`select='gt(scene,X)'`) and writes only the
+    selected frames (plus the first frame) as JPEGs, with `showinfo` reporting their timestamps.
+    The scene changes are then offered to the same `selector` (_KeyframeSelector: spacing, dedupe,
+    revisits, budget) and `writer` (_KeyframeWriter) as in the OpenCV backend, so both return the
+    same entries; kept JPEGs are written as ffmpeg encoded them. `threads` is passed to ffmpeg.
+
+    Every selected frame is first dumped into a temp dir under `scratch_dir` (default: the output
+    dir), so pointing it at a job scratch dir keeps the discarded frames off the output disk.
+    """
+    tmp_dir = tempfile.mkdtemp(dir=scratch_dir or writer.output_dir, prefix=".scenes-")
+    try:
+        threads_args = ["-threads", str(threads)] if threads and threads > 1 else []
+        proc = subprocess.run([
+            "ffmpeg", "-hide_banner", *threads_args, "-i", video_path, "-an",
+            "-vf", f"select='eq(n,0)+gt(scene,{scene_thresh})',showinfo",
+            "-vsync", "vfr", "-q:v", "2", os.path.join(tmp_dir, "scene_%06d.jpg"), "-y"
+        ], capture_output=True, text=True)
+        if proc.returncode != 0:
+            raise RuntimeError(f"ffmpeg scene detection failed: {proc.stderr[-500:]}")
+        times = [float(t) for t in SHOWINFO_RE.findall(proc.stderr)]
+
+        keyframes = []
+        for idx, sec in enumerate(times, 1):
+            src = os.path.join(tmp_dir, f"scene_{idx:06d}.jpg")
+            if not selector.due(sec) or not os.path.exists(src):
+                continue
+            with open(src, "rb") as f:
+                jpeg = f.read()
+            frame = cv2.imdecode(np.frombuffer(jpeg, np.uint8), cv2.IMREAD_COLOR)
+            if frame is None:
+                continue
+            ok, revisit_of = selector.offer(sec, _phash(frame, hash_method))
+            if not ok:
+                continue
+            frame_id = int(round(sec * fps))
+            if revisit_of is not None:
+                keyframe = writer.revisit(keyframes, revisit_of, frame_id, selector.last_change)
+            else:
+                keyframe = writer.write(frame, frame_id, selector.last_change, jpeg=jpeg)
+            keyframes.append(keyframe)
+            yield keyframe
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
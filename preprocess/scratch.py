@@ -0,0 +1,41 @@
+import os
+import time
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+# Where per-job scratch space is created. Point it at a tmpfs (e.g. /dev/shm) to keep large
+# intermediate files off the root disk; defaults to the system temp dir
+SCRATCH_DIR = os.getenv("SCRATCH_DIR") or None
+SCRATCH_PREFIX = "betterhack-job-"
+# Leftovers from jobs killed before their cleanup ran are removed after this long
+STALE_SCRATCH_SECONDS = 6 * 3600
+
+def scratch_root():
+    if SCRATCH_DIR and not os.path.isdir(SCRATCH_DIR):
+        print(f"[WARN] SCRATCH_DIR {SCRATCH_DIR} does not exist, using {tempfile.gettempdir()}")
+        return None
+    return SCRATCH_DIR
+
+@contextmanager
+def job_scratch(job_id=""):
+    """
+    Private scratch directory for one job, removed when the job finishes or fails.
+    Concurrent jobs each get their own directory, so intermediate files never collide.
+    """
+    path = tempfile.mkdtemp(prefix=f"{SCRATCH_PREFIX}{job_id}-", dir=scratch_root())
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+def cleanup_stale_scratch(max_age=STALE_SCRATCH_SECONDS):
+    """Remove job scratch directories older than `max_age` seconds (left behind by crashed workers)."""
+    root = scratch_root() or tempfile.gettempdir()
+    cutoff = time.time() - max_age
+    for entry in os.scandir(root):
+        try:
+            if entry.name.startswith(SCRATCH_PREFIX) and entry.is_dir() and entry.stat().st_mtime < cutoff:
+                shutil.rmtree(entry.path, ignore_errors=True)
+        except OSError:
+            pass
@@ -0,0 +1,22 @@
+import os
+import tempfile
+
+def atomic_write_bytes(path, data):
+    """
+    Write `data` to `path` via a temp file in the same directory and os.replace(), so concurrent
+    readers (and jobs writing the same name) never see a partially written file.
+    """
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def atomic_write_text(path, text, encoding="utf-8"):
+    atomic_write_bytes(path, text.encode(encoding))
@@ -1,21 +1,142 @@
+import os
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import whisper
+from preprocess.transcript import Transcript
 
-def format_timestamp(seconds):
-    m = int(seconds // 60)
-    s = int(seconds % 60)
-    return f"[{m:02d}:{s:02d}]"
-
-def transcribe_audio(audio_path):
-    model = whisper.load_model("base")
-    result = model.transcribe(audio_path)
-    transcript = []
-    for seg in result.get('segments', []):
-        start = format_timestamp(seg['start'])
-        end = format_timestamp(seg['end'])
-        text = seg['text'].strip()
-        transcript.append({
-            'start': start,
-            'end': end,
-            'text': text
-        })
-    return transcript
+# Model size used when none is requested
+DEFAULT_MODEL = os.getenv("WHISPER_MODEL", "base")
+# Limits on the models kept loaded per process; the least recently used model is dropped first
+MAX_MODELS = int(os.getenv("WHISPER_MAX_MODELS", 1))
+MAX_MODEL_MEMORY_MB = float(os.getenv("WHISPER_MAX_MEMORY_MB", 0)) or None
+WHISPER_DEVICE = os.getenv("WHISPER_DEVICE") or None
+
+# name -> (model, lock, size_mb); the per-model lock serializes transcribe() calls, since Whisper
+# installs decoding hooks on the model while it runs
+_MODELS = OrderedDict()
+_MODELS_LOCK = threading.Lock()
+
+# Worker pools for chunked transcription, one per (workers, model_name) and kept alive so workers
+# load their model only once; callers asking for different pools never tear down each other's
+_POOLS = {}
+_POOL_LOCK = threading.Lock()
+# Feeds chunks to the pool for transcriptions started with submit_transcription
+_SUBMIT_THREADS = ThreadPoolExecutor(thread_name_prefix="transcribe")
+
+def _model_size_mb(model):
+    return sum(p.numel() * p.element_size() for p in model.parameters()) / 2**20
+
+def _evict():
+    """Drop least recently used models beyond MAX_MODELS / MAX_MODEL_MEMORY_MB, always keeping the newest."""
+    while len(_MODELS) > 1:
+        total_mb = sum(entry[2] for entry in _MODELS.values())
+        if len(_MODELS) <= MAX_MODELS and (MAX_MODEL_MEMORY_MB is None or total_mb <= MAX_MODEL_MEMORY_MB):
+            break
+        name, _ = _MODELS.popitem(last=False)
+        print(f"Unloaded Whisper model '{name}'")
+
+def _get_entry(name=None):
+    name = name or DEFAULT_MODEL
+    with _MODELS_LOCK:
+        entry = _MODELS.get(name)
+        if entry is None:
+            model = whisper.load_model(name, device=WHISPER_DEVICE)
+            entry = (model, threading.Lock(), _model_size_mb(model))
+            _MODELS[name] = entry
+            print(f"Loaded Whisper model '{name}' ({entry[2]:.0f} MB)")
+        _MODELS.move_to_end(name)
+        _evict()
+        return entry
+
+def get_model(name=None):
+    """
+    Return the Whisper model `name` (default WHISPER_MODEL), loading it at most once per process.
+    Thread-safe: concurrent callers wait for a single load instead of each loading their own copy.
+    """
+    return _get_entry(name)[0]
+
+def warm_model(name=None):
+    """Load the model ahead of the first transcription (e.g. at API startup)."""
+    get_model(name)
+
+def _transcribe_chunk(pcm, offset, model_name=None):
+    """Transcribe one slice of audio; segment times are shifted by `offset` seconds."""
+    model, lock, _ = _get_entry(model_name)
+    with lock:
+        result = model.transcribe(pcm)
+    return [
+        {'start': seg['start'] + offset, 'end': seg['end'] + offset, 'text': seg['text']}
+        for seg in result.get('segments', [])
+    ]
+
+def _init_worker(model_name, threads):
+    import torch
+    torch.set_num_threads(threads)
+    warm_model(model_name)
+
+def _chunk_task(args):
+    return _transcribe_chunk(*args)
+
+def _transcribe_task(audio, model_name):
+    return Transcript.from_segments(_transcribe_chunk(audio, 0.0, model_name))
+
+def _get_pool(workers, model_name):
+    with _POOL_LOCK:
+        pool = _POOLS.get((workers, model_name))
+        if pool is None:
+            threads = max(1, (os.cpu_count() or 1) // workers)
+            # spawn, not fork: forking a process that already runs torch threads can deadlock
+            pool = _POOLS[(workers, model_name)] = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker, initargs=(model_name, threads))
+        return pool
+
+def warm_pool(workers=1, model_name=None):
+    """Start the transcription worker processes and load their models ahead of the first job."""
+    pool = _get_pool(max(1, workers), model_name)
+    for f in [pool.submit(int) for _ in range(max(1, workers))]:
+        f.result()
+
+def transcribe_chunked(audio, model_name=None, workers=1):
+    """
+    Split audio on silence (preprocess.vad) and transcribe the speech chunks, in `workers` worker
+    processes when > 1. Segments are stitched back in order with global timestamps; silent
+    stretches are never sent to the model. Returns raw segments with float start/end.
+    """
+    from preprocess.extract_audio import SAMPLE_RATE, extract_audio_pcm
+    from preprocess.vad import speech_chunks
+    pcm = extract_audio_pcm(audio) if isinstance(audio, str) else audio
+    tasks = [(pcm[int(start * SAMPLE_RATE):int(end * SAMPLE_RATE)], start, model_name)
+             for start, end in speech_chunks(pcm, SAMPLE_RATE)]
+    if workers > 1 and len(tasks) > 1:
+        results = _get_pool(workers, model_name).map(_chunk_task, tasks)
+    else:
+        results = map(_chunk_task, tasks)
+    return [seg for chunk in results for seg in chunk]
+
+def transcribe_audio(audio_path, model_name=None, workers=None):
+    """
+    Transcribe with Whisper. `audio_path` may be a file path or a 16 kHz mono float32 array
+    (see preprocess.extract_audio.extract_audio_pcm), which skips Whisper's own ffmpeg decode.
+    The model comes from the process-wide cache (see get_model). Returns a
+    preprocess.transcript.Transcript.
+
+    With `workers` set, the audio is split on silence and the chunks are transcribed in parallel
+    worker processes (see transcribe_chunked); the result has the same format.
+    """
+    if workers:
+        return Transcript.from_segments(transcribe_chunked(audio_path, model_name, workers))
+    return Transcript.from_segments(_transcribe_chunk(audio_path, 0.0, model_name))
+
+def submit_transcription(audio, model_name=None, workers=None):
+    """
+    Start transcribe_audio(audio) without blocking and return a Future of the transcript.
+    Whisper always runs in the worker pool (at least one process), so it doesn't compete with the
+    caller's frame decoding for the GIL; with `workers` > 1 the audio is chunked as in transcribe_chunked.
+    """
+    workers = max(1, workers or 0)
+    if workers > 1:
+        return _SUBMIT_THREADS.submit(transcribe_audio, audio, model_name, workers)
+    return _get_pool(1, model_name).submit(_transcribe_task, audio, model_name)
@@ -0,0 +1,143 @@
+import re
+import json
+
+# Adjacent segments are merged into one prompt line while the pause between them is at most
+# MERGE_GAP seconds and the line stays under MERGE_CHARS characters
+MERGE_GAP = 1.5
+MERGE_CHARS = 300
+# Version tag of the columnar storage format
+FORMAT_VERSION = 1
+
+_STAMP = re.compile(r"^\[(\d+):(\d{2})\]\s*(.*)$")
+
+def format_timestamp(seconds):
+    m = int(seconds // 60)
+    s = int(seconds % 60)
+    return f"[{m:02d}:{s:02d}]"
+
+def parse_timestamp(value):
+    """Seconds from a "[mm:ss]" string (as produced by format_timestamp) or a number."""
+    if isinstance(value, str):
+        m, s = value.strip("[] ").split(":")
+        return int(m) * 60 + int(s)
+    return float(value)
+
+class Transcript:
+    """
+    Timed transcript segments stored as three columns (start and end seconds, text).
+
+    In prompts (str() / f-strings) it renders as compact text: adjacent segments coalesced,
+    one "[mm:ss]" timestamp per line. dumps()/loads() are the columnar storage format, which
+    is also what gets pickled into the result cache.
+    """
+
+    __slots__ = ("starts", "ends", "texts")
+
+    def __init__(self, starts=None, ends=None, texts=None):
+        self.starts = list(starts or [])
+        self.ends = list(ends or [])
+        self.texts = list(texts or [])
+
+    @classmethod
+    def from_segments(cls, segments):
+        """From Whisper segments, or dicts with "[mm:ss]" start/end strings (the old transcript format)."""
+        transcript = cls()
+        for seg in segments:
+            transcript.append(parse_timestamp(seg['start']), parse_timestamp(seg['end']), seg['text'])
+        return transcript
+
+    @classmethod
+    def coerce(cls, value):
+        """A Transcript from a Transcript, a list of segments or rendered text; None stays None."""
+        if value is None or isinstance(value, cls):
+            return value
+        if isinstance(value, str):
+            return cls.parse(value)
+        return cls.from_segments(value)
+
+    def append(self, start, end, text):
+        text = text.strip()
+        if text:
+            self.starts.append(round(float(start), 2))
+            self.ends.append(round(float(end), 2))
+            self.texts.append(text)
+
+    def extend(self, other):
+        self.starts.extend(other.starts)
+        self.ends.extend(other.ends)
+        self.texts.extend(other.texts)
+
+    def copy(self):
+        return Transcript(self.starts, self.ends, self.texts)
+
+    def __len__(self):
+        return len(self.texts)
+
+    def __eq__(self, other):
+        return (isinstance(other, Transcript) and self.starts == other.starts
+                and self.ends == other.ends and self.texts == other.texts)
+
+    def segments(self):
+        """The segments as dicts with start/end in seconds."""
+        return [{'start': s, 'end': e, 'text': t} for s, e, t in zip(self.starts, self.ends, self.texts)]
+
+    def lines(self, merge_gap=MERGE_GAP, max_chars=MERGE_CHARS):
+        lines = []
+        line_start = line_end = None
+        parts, size = [], 0
+        for start, end, text in zip(self.starts, self.ends, self.texts):
+            if parts and (start - line_end > merge_gap or size + len(text) > max_chars):
+                lines.append(f"{format_timestamp(line_start)} {' '.join(parts)}")
+                parts, size = [], 0
+            if not parts:
+                line_start = start
+            parts.append(text)
+            size += len(text) + 1
+            line_end = end
+        if parts:
+            lines.append(f"{format_timestamp(line_start)} {' '.join(parts)}")
+        return lines
+
+    def render(self, merge_gap=MERGE_GAP, max_chars=MERGE_CHARS):
+        """Compact prompt text: one "[mm:ss] text" line per run of adjacent segments."""
+        return "\n".join(self.lines(merge_gap, max_chars))
+
+    def __str__(self):
+        return self.render()
+
+    def __repr__(self):
+        return f"Transcript({len(self)} segments)"
+
+    @classmethod
+    def parse(cls, text):
+        """Read rendered text back; each line ends where the next one starts. Lines without a timestamp continue the previous one."""
+        starts, texts = [], []
+        for line in text.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            match = _STAMP.match(line)
+            if match:
+                starts.append(int(match.group(1)) * 60 + int(match.group(2)))
+                texts.append(match.group(3))
+            elif texts:
+                texts[-1] = f"{texts[-1]} {line}"
+            else:
+                starts.append(0)
+                texts.append(line)
+        return cls(starts, starts[1:] + starts[-1:], texts)
+
+    def dumps(self):
+        """Columnar JSON: one array per column instead of a dict per segment."""
+        return json.dumps({"v": FORMAT_VERSION, "start": self.starts, "end": self.ends, "text": self.texts},
+                          ensure_ascii=False, separators=(",", ":"))
+
+    @classmethod
+    def loads(cls, data):
+        columns = json.loads(data)
+        if columns.get("v") != FORMAT_VERSION:
+            raise ValueError(f"Unsupported transcript format version: {columns.get('v')}")
+        return cls(columns["start"], columns["end"], columns["text"])
+
+    def __reduce__(self):
+        return (Transcript.loads, (self.dumps(),))
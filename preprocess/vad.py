@@ -0,0 +1,91 @@
+import numpy as np
+
+# Analysis frame for the energy detector
+FRAME_MS = 30
+# Frames louder than the noise floor (10th percentile) by this many dB count as speech...
+SPEECH_MARGIN_DB = 12.0
+# ...but never anything quieter than this absolute level, and anything louder than the ceiling always
+# counts (otherwise audio that is loud throughout, e.g. narration over music, has no "floor" to exceed)
+MIN_SPEECH_DB = -50.0
+MAX_SPEECH_THRESHOLD_DB = -35.0
+# Speech runs closer than this are merged; shorter runs are dropped as clicks
+MIN_SILENCE = 0.6
+MIN_SPEECH = 0.25
+# Padding kept around each region so words aren't clipped
+PAD = 0.2
+
+def _frame_db(pcm, frame_len):
+    n = len(pcm) // frame_len
+    frames = pcm[:n * frame_len].reshape(n, frame_len)
+    rms = np.sqrt(np.mean(frames.astype(np.float64) ** 2, axis=1))
+    return 20 * np.log10(np.maximum(rms, 1e-10))
+
+def is_silent(pcm, sample_rate=16000):
+    """True if no frame of `pcm` reaches MIN_SPEECH_DB, i.e. there is nothing Whisper could transcribe."""
+    frame_len = int(sample_rate * FRAME_MS / 1000)
+    return len(pcm) < frame_len or bool(np.all(_frame_db(pcm, frame_len) <= MIN_SPEECH_DB))
+
+def speech_regions(pcm, sample_rate=16000):
+    """
+    Lightweight energy-based VAD. Returns [(start_sec, end_sec), ...] for the stretches of `pcm`
+    (mono float32) that contain sound well above the recording's noise floor.
+    """
+    frame_len = int(sample_rate * FRAME_MS / 1000)
+    if len(pcm) < frame_len:
+        return []
+    db = _frame_db(pcm, frame_len)
+    threshold = min(max(np.percentile(db, 10) + SPEECH_MARGIN_DB, MIN_SPEECH_DB), MAX_SPEECH_THRESHOLD_DB)
+    voiced = db > threshold
+    frame_sec = frame_len / sample_rate
+
+    regions = []
+    start = None
+    for i, v in enumerate(voiced):
+        if v and start is None:
+            start = i
+        elif not v and start is not None:
+            regions.append([start * frame_sec, i * frame_sec])
+            start = None
+    if start is not None:
+        regions.append([start * frame_sec, len(voiced) * frame_sec])
+
+    merged = []
+    for r in regions:
+        if merged and r[0] - merged[-1][1] < MIN_SILENCE:
+            merged[-1][1] = r[1]
+        else:
+            merged.append(r)
+    duration = len(pcm) / sample_rate
+    regions = [(max(0.0, s - PAD), min(duration, e + PAD)) for s, e in merged if e - s >= MIN_SPEECH]
+    if not regions and _frame_db(pcm, len(pcm))[0] > MIN_SPEECH_DB:
+        # Audible but without a quieter floor to stand out from: keep all of it rather than drop speech
+        return [(0.0, duration)]
+    return regions
+
+def _split_long(pcm, start, end, sample_rate, max_seconds):
+    """Cut a region longer than `max_seconds` at the quietest frame of each window's last quarter."""
+    frame_len = int(sample_rate * FRAME_MS / 1000)
+    pieces = []
+    while end - start > max_seconds:
+        lo = int((start + max_seconds * 0.75) * sample_rate)
+        hi = int((start + max_seconds) * sample_rate)
+        db = _frame_db(pcm[lo:hi], frame_len)
+        cut = (lo + int(np.argmin(db)) * frame_len) / sample_rate if len(db) else start + max_seconds
+        pieces.append((start, cut))
+        start = cut
+    pieces.append((start, end))
+    return pieces
+
+def speech_chunks(pcm, sample_rate=16000, max_seconds=30.0, merge_gap=1.5):
+    """
+    Group speech regions into chunks of at most `max_seconds` for transcription. Regions separated
+    by less than `merge_gap` seconds share a chunk; longer silences are left out entirely, so they
+    never reach the model. Returns [(start_sec, end_sec), ...].
+    """
+    chunks = []
+    for start, end in speech_regions(pcm, sample_rate):
+        if chunks and start - chunks[-1][1] < merge_gap and end - chunks[-1][0] <= max_seconds:
+            chunks[-1] = (chunks[-1][0], end)
+        else:
+            chunks.extend(_split_long(pcm, start, end, sample_rate, max_seconds))
+    return chunks
@@ -22,7 +22,12 @@ def record_screen_with_audio_and_camera(output_path="output_recording.mp4", dura
     import sounddevice as sd
     import soundfile as sf
     import tempfile
+    import shutil
     import os
+    from preprocess.scratch import SCRATCH_PREFIX, scratch_root
+
+    # Raw video/audio go to a private scratch dir; leftovers of a crashed recording are swept by cleanup_stale_scratch
+    scratch_dir = tempfile.mkdtemp(prefix=f"{SCRATCH_PREFIX}recording-", dir=scratch_root())
 
     # Screen capture setup
     sct = mss.mss()
@@ -38,7 +43,7 @@ def record_screen_with_audio_and_camera(output_path="output_recording.mp4", dura
     audio_q = queue.Queue()
     samplerate = 44100
     channels = 2
-    audio_file = tempfile.mktemp(suffix=".wav")
+    audio_file = os.path.join(scratch_dir, "audio.wav")
 
     def audio_callback(indata, frames, time, status):
         audio_q.put(indata.copy())
@@ -47,7 +52,7 @@ def record_screen_with_audio_and_camera(output_path="output_recording.mp4", dura
 
     # Video writer setup
     fourcc = cv2.VideoWriter_fourcc(*"mp4v")
-    video_file = tempfile.mktemp(suffix=".mp4")
+    video_file = os.path.join(scratch_dir, "video.mp4")
     out = cv2.VideoWriter(video_file, fourcc, fps, (screen_width, screen_height))
 
     # Start audio
@@ -109,10 +114,11 @@ def record_screen_with_audio_and_camera(output_path="output_recording.mp4", dura
         "-strict", "experimental",
         output_path
     ]
-    subprocess.run(cmd, check=True)
-    # Cleanup temp files
-    os.remove(video_file)
-    os.remove(audio_file)
+    try:
+        subprocess.run(cmd, check=True)
+    finally:
+        # Cleanup temp files
+        shutil.rmtree(scratch_dir, ignore_errors=True)
     print(f"Screen recording saved to {output_path}")
 
 if __name__ == "__main__":